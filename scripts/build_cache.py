@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+КЭШ ИНКРЕМЕНТАЛЬНОЙ СБОРКИ ГРАФИКОВ
+===================================
+
+Маленький аналог make для PNG-графиков: для каждого выходного файла хранится
+хэш содержимого его входных столбцов, параметров и исходного кода модуля
+функции, которая его рисует (вместе с константами и помощниками этого модуля),
+а также модулей-помощников, из которых она импортирует. Если хэш не изменился
+и файл на месте - график не перерисовывается.
+
+Автор: Optical Connectome Research Team
+"""
+
+import os
+import json
+import hashlib
+import inspect
+import pandas as pd
+
+CACHE_PATH = '.build_cache.json'
+
+def fingerprint(df, columns, params=None, func=None, modules=()):
+    """Хэш входных столбцов df, параметров, исходного кода модуля func и модулей modules
+    
+    Берётся исходник всего модуля, а не только func: правка констант модуля или
+    его вспомогательных функций тоже делает выходной файл устаревшим.
+    """
+    h = hashlib.sha256()
+    for column in columns:
+        h.update(column.encode('utf-8'))
+        h.update(str(df[column].dtype).encode('utf-8'))
+        h.update(pd.util.hash_pandas_object(df[column], index=False).values.tobytes())
+    h.update(json.dumps(params or {}, sort_keys=True, default=str).encode('utf-8'))
+    sources = ([inspect.getmodule(func)] if func is not None else []) + list(modules)
+    for module in sources:
+        h.update(inspect.getsource(module).encode('utf-8'))
+    return h.hexdigest()
+
+class BuildCache:
+    """Записи выходной файл -> {key: хэш входов, ...метаданные} в JSON"""
+    
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+    
+    def is_fresh(self, output, key):
+        """Файл существует и собран из тех же входов"""
+        return os.path.exists(output) and self.entries.get(output, {}).get('key') == key
+    
+    def meta(self, output):
+        return self.entries.get(output, {})
+    
+    def record(self, output, key, **meta):
+        self.entries[output] = {'key': key, **meta}
+        self.save()
+    
+    def save(self):
+        # Временный файл рядом и атомарная замена; open() учитывает umask (права как у PNG)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+ГРАФ ОПТИЧЕСКОГО КОННЕКТОМА
+===========================
+
+Построение разреженной матрицы смежности трактов по OPC: вес ребра
+(opc_i + opc_j) / 2, ребро есть, если вес выше порога. Порог проверяется
+точно через сортировку OPC и searchsorted (без попарных весов n x n),
+результат - симметричная scipy.sparse CSR-матрица, которую можно передать
+в networkx.
+
+Региональные матрицы: концы трактов относятся к парцеллам (объём меток или
+регулярная сетка), по парам парцелл накапливаются число трактов и средние
+OPC/T/V - тоже разреженные CSR-матрицы, по одной на субъект.
+load_region_edges сводит сохранённые матрицы всех субъектов в таблицу рёбер
+(для Figure 4).
+
+Автор: Optical Connectome Research Team
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import networkx as nx
+
+def opc_adjacency(opc, threshold=0.4, n_neighbors=None):
+    """Симметричная CSR-матрица смежности (n, n) по OPC трактов
+    
+    Вес (opc_i + opc_j) / 2 > threshold <=> opc_j > 2 * threshold - opc_i, поэтому
+    после сортировки OPC допустимые соседи узла - суффикс отсортированного массива,
+    его начало находит searchsorted. Без n_neighbors возвращаются все такие рёбра
+    (их может быть ~n^2). n_neighbors - у каждого узла остаются k допустимых
+    соседей с ближайшими по рангу OPC (окно в отсортированном порядке): это
+    граф сходства трактов, а не k глобально самых тяжёлых рёбер, которые у всех
+    узлов ведут к одним и тем же трактам с максимальным OPC. Граф объединяет
+    выбор обоих концов, степень узла порядка 2k, память O(n * k).
+    """
+    if n_neighbors is not None and n_neighbors < 1:
+        raise ValueError("n_neighbors должен быть >= 1")
+    opc = np.asarray(opc, dtype=np.float64)
+    n = len(opc)
+    if n == 0:
+        return sp.csr_matrix((0, 0))
+    
+    order = np.argsort(opc, kind="stable")
+    sorted_opc = opc[order]
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    # Первый допустимый ранг для каждого узла
+    first = np.searchsorted(sorted_opc, 2 * threshold - opc, side="right")
+    
+    if n_neighbors is None:
+        # Все рёбра: ранги first_i..n-1 без самого узла
+        counts = n - first
+        i = np.repeat(np.arange(n), counts)
+        j_rank = np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+    else:
+        # Окно из k + 1 рангов вокруг своего ранга, прижатое к [first_i, n)
+        width = min(n_neighbors + 1, n)
+        start = np.clip(rank - n_neighbors // 2, first, np.maximum(first, n - width))
+        j_rank = start[:, None] + np.arange(width)
+        i = np.repeat(np.arange(n), width)
+        j_rank = j_rank.ravel()
+    
+    valid = j_rank < n
+    i, j_rank = i[valid], j_rank[valid]
+    j = order[j_rank]
+    keep = i != j  # без петель
+    i, j = i[keep], j[keep]
+    if n_neighbors is not None:
+        # Окно на k + 1 рангов: если своего ранга в нём нет, лишний - самый дальний
+        i, j = _closest_per_row(i, j, rank, n_neighbors)
+    
+    weights = (opc[i] + opc[j]) / 2
+    adjacency = sp.csr_matrix((weights, (i, j)), shape=(n, n))
+    # Симметризация: ребро, выбранное хотя бы одним концом (веса совпадают)
+    return adjacency.maximum(adjacency.T).tocsr()
+
+def _closest_per_row(i, j, rank, k):
+    """Оставить у каждого i не более k пар (i, j) с наименьшим |rank_i - rank_j|"""
+    distance = np.abs(rank[i] - rank[j])
+    order = np.lexsort((distance, i))
+    i, j = i[order], j[order]
+    position = np.arange(len(i)) - np.searchsorted(i, i, side="left")
+    keep = position < k
+    return i[keep], j[keep]
+
+def adjacency_to_graph(adjacency, node_attrs=None):
+    """networkx.Graph из CSR-матрицы; node_attrs - {имя: массив значений по узлам}"""
+    upper = sp.triu(adjacency, k=1).tocoo()
+    G = nx.Graph()
+    G.add_nodes_from(range(adjacency.shape[0]))
+    G.add_weighted_edges_from(zip(upper.row.tolist(), upper.col.tolist(), upper.data.tolist()))
+    for name, values in (node_attrs or {}).items():
+        nx.set_node_attributes(G, dict(enumerate(np.asarray(values).tolist())), name)
+    return G
+
+# ========== Региональные матрицы связности ==========
+REGION_VALUES = ("OPC_mean", "T_mean", "V_mean")
+
+def grid_parcellation(shape, n_cells=(4, 4, 4)):
+    """Регулярная сетка парцелл на объёме shape: метки 1..prod(n_cells), int32"""
+    axes = [np.minimum(np.arange(size) * cells // size, cells - 1)
+            for size, cells in zip(shape[:3], n_cells)]
+    ix, iy, iz = np.meshgrid(*axes, indexing="ij")
+    return (np.ravel_multi_index((ix, iy, iz), tuple(n_cells)) + 1).astype(np.int32)
+
+def endpoint_parcels(coords, offsets, labels, rows=None):
+    """Метки парцелл первой и последней точки трактов rows (по умолчанию всех)
+    
+    Координаты воксельные; точки вне объёма прижимаются к границе; метка 0 - фон.
+    """
+    offsets = np.asarray(offsets)
+    if rows is None:
+        rows = np.arange(len(offsets) - 1)
+    shape = np.array(labels.shape[:3])
+    result = []
+    for point_rows in (offsets[rows], offsets[rows + 1] - 1):
+        points = np.rint(coords[point_rows]).astype(np.int64)
+        points = np.clip(points, 0, shape - 1)
+        result.append(labels[points[:, 0], points[:, 1], points[:, 2]])
+    return result[0], result[1]
+
+def region_matrices(parcel_a, parcel_b, n_regions, values=None):
+    """Симметричные CSR-матрицы (n_regions, n_regions) по парам парцелл концов трактов
+    
+    parcel_a/parcel_b - метки 1..n_regions (0 - фон, такие тракты пропускаются).
+    Возвращает {"count": число трактов, имя: средние values[имя] по трактам пары}.
+    """
+    parcel_a = np.asarray(parcel_a, dtype=np.int64)
+    parcel_b = np.asarray(parcel_b, dtype=np.int64)
+    valid = (parcel_a > 0) & (parcel_b > 0)
+    lo = np.minimum(parcel_a, parcel_b)[valid] - 1
+    hi = np.maximum(parcel_a, parcel_b)[valid] - 1
+    
+    # Пары регионов -> плотные номера, суммы через bincount
+    pairs, inverse = np.unique(lo * n_regions + hi, return_inverse=True)
+    rows, cols = np.divmod(pairs, n_regions)
+    counts = np.bincount(inverse, minlength=len(pairs)).astype(np.float64)
+    
+    def symmetric(weights):
+        off = rows != cols
+        matrix = sp.coo_matrix((np.concatenate([weights, weights[off]]),
+                                (np.concatenate([rows, cols[off]]), np.concatenate([cols, rows[off]]))),
+                               shape=(n_regions, n_regions))
+        return matrix.tocsr()
+    
+    matrices = {"count": symmetric(counts)}
+    for name, column in (values or {}).items():
+        column = np.asarray(column, dtype=np.float64)[valid]
+        matrices[name] = symmetric(np.bincount(inverse, weights=column, minlength=len(pairs)) / counts)
+    return matrices
+
+def subject_region_matrices(store, file_info, labels=None, n_cells=(4, 4, 4)):
+    """Матрицы регион x регион для каждого субъекта из TractStore
+    
+    labels - объём меток парцелл (общий для всех субъектов); без него - сетка n_cells.
+    """
+    file_names = np.asarray(store["file_name"])
+    matrices = {}
+    for info in file_info:
+        rows = np.flatnonzero(file_names == info["file_name"])
+        if labels is None:
+            subject_labels = grid_parcellation(info["data_shape"], n_cells)
+            n_regions = int(np.prod(n_cells))
+        else:
+            subject_labels = labels
+            n_regions = int(labels.max())
+        a, b = endpoint_parcels(store.coords, store.offsets, subject_labels, rows)
+        values = {name: np.asarray(store[name])[rows] for name in REGION_VALUES}
+        matrices[info["file_name"]] = region_matrices(a, b, n_regions, values)
+    return matrices
+
+def save_region_matrices(matrices, path):
+    """Сохранить матрицы в каталог path: <субъект>_<матрица>.npz (scipy.sparse.save_npz)"""
+    os.makedirs(path, exist_ok=True)
+    for subject, subject_matrices in matrices.items():
+        stem = subject.split(".")[0]
+        for name, matrix in subject_matrices.items():
+            sp.save_npz(os.path.join(path, f"{stem}_{name}.npz"), matrix)
+
+def load_region_edges(path, values=REGION_VALUES):
+    """Рёбра регион-регион по всем субъектам из каталога save_region_matrices
+    
+    Число трактов суммируется по субъектам, средние values - взвешенно по числу
+    трактов. Возвращает DataFrame (region_a <= region_b, метки с 1): count и values.
+    """
+    count_files = sorted(f for f in os.listdir(path) if f.endswith("_count.npz"))
+    if not count_files:
+        raise FileNotFoundError(f"В {path} нет региональных матриц (*_count.npz)")
+    
+    count = None
+    sums = {}
+    for name in count_files:
+        stem = name[:-len("_count.npz")]
+        subject_count = sp.load_npz(os.path.join(path, name)).tocsr()
+        count = subject_count if count is None else count + subject_count
+        for value in values:
+            mean = sp.load_npz(os.path.join(path, f"{stem}_{value}.npz")).tocsr()
+            weighted = mean.multiply(subject_count)
+            sums[value] = weighted if value not in sums else sums[value] + weighted
+    
+    upper = sp.triu(count).tocoo()
+    edges = {"region_a": upper.row + 1, "region_b": upper.col + 1, "count": upper.data}
+    for value in values:
+        edges[value] = np.asarray(sums[value].tocsr()[upper.row, upper.col]).ravel() / upper.data
+    return pd.DataFrame(edges)
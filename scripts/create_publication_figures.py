@@ -12,6 +12,9 @@
 Автор: Optical Connectome Research Team
 """
 
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -21,6 +24,11 @@ import networkx as nx
 from scipy import stats
 from scipy.spatial.distance import pdist, squareform
 from sklearn.preprocessing import StandardScaler
+from metrics_io import load_metrics
+from build_cache import BuildCache, fingerprint
+import scipy.sparse as sp
+import connectome_graph
+from connectome_graph import adjacency_to_graph, load_region_edges
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -28,12 +36,32 @@ warnings.filterwarnings('ignore')
 plt.style.use('seaborn-v0_8')
 sns.set_palette("husl")
 
-def create_figure_1_distributions():
+METRICS_PATH = 'ds006181_fixed_metrics.csv'
+MULTI_PATH = 'multi_dataset_optical_metrics.csv'
+REGIONS_PATH = 'ds006181_region_matrices'
+
+# Столбцы, которые нужны каждому графику
+FIGURE_COLUMNS = {
+    1: ['V_mean', 'T_mean', 'OPC_mean', 'DEA_OPC', 'KACI_OPC_realistic', 'length'],
+    2: ['V_mean', 'T_mean', 'OPC_mean', 'DEA_OPC', 'KACI_OPC_realistic', 'length'],
+    3: ['OPC_mean', 'length'],
+    4: ['region_a', 'region_b', 'count', 'OPC_mean'],
+    5: ['V', 'T', 'OPC', 'DEA_OPC', 'dataset']
+}
+
+# Модули-помощники графиков: их исходники входят в ключ кэша сборки
+FIGURE_MODULES = (connectome_graph,)
+
+# Граф Figure 4: предел числа узлов для подписей
+NETWORK_MAX_LABELS = 50
+
+def create_figure_1_distributions(df=None):
     """Figure 1: Распределения основных метрик"""
     print("📊 Создаем Figure 1: Распределения метрик...")
     
-    # Загружаем данные
-    df = pd.read_csv('ds006181_fixed_metrics.csv')
+    # Загружаем данные (если не переданы)
+    if df is None:
+        df = load_metrics(METRICS_PATH, columns=FIGURE_COLUMNS[1])
     
     fig, axes = plt.subplots(2, 3, figsize=(18, 12))
     fig.suptitle('Optical Connectome Metrics Distribution', fontsize=16, fontweight='bold')
@@ -98,12 +126,13 @@ def create_figure_1_distributions():
     
     print("✅ Figure 1 сохранена: Figure1_Distributions.png")
 
-def create_figure_2_correlations():
+def create_figure_2_correlations(df=None):
     """Figure 2: Тепловая карта корреляций"""
     print("📊 Создаем Figure 2: Корреляционная матрица...")
     
-    # Загружаем данные
-    df = pd.read_csv('ds006181_fixed_metrics.csv')
+    # Загружаем данные (если не переданы)
+    if df is None:
+        df = load_metrics(METRICS_PATH, columns=FIGURE_COLUMNS[2])
     
     # Выбираем метрики для корреляции
     metrics = ['V_mean', 'T_mean', 'OPC_mean', 'DEA_OPC', 'KACI_OPC_realistic', 'length']
@@ -141,12 +170,13 @@ def create_figure_2_correlations():
     
     print("✅ Figure 2 сохранена: Figure2_Correlations.png")
 
-def create_figure_3_3d_tracts():
+def create_figure_3_3d_tracts(df=None, seed=0):
     """Figure 3: 3D визуализация трактов"""
     print("📊 Создаем Figure 3: 3D визуализация трактов...")
     
-    # Загружаем данные
-    df = pd.read_csv('ds006181_fixed_metrics.csv')
+    # Загружаем данные (если не переданы)
+    if df is None:
+        df = load_metrics(METRICS_PATH, columns=FIGURE_COLUMNS[3])
     
     # Выбираем топ-10 трактов по OPC
     top_tracts = df.nlargest(10, 'OPC_mean')
@@ -157,16 +187,19 @@ def create_figure_3_3d_tracts():
     # Цветовая схема по OPC
     colors = plt.cm.viridis(top_tracts['OPC_mean'] / top_tracts['OPC_mean'].max())
     
+    # Независимый поток на каждый тракт
+    tract_seeds = np.random.SeedSequence(seed).spawn(len(top_tracts))
+    
     for i, (_, tract) in enumerate(top_tracts.iterrows()):
         # Создаем 3D тракт (упрощенная версия)
         length = tract['length']
         n_points = max(20, int(length / 2))
         
         # Случайная траектория
-        np.random.seed(i)  # Для воспроизводимости
+        rng = np.random.default_rng(tract_seeds[i])  # Для воспроизводимости
         x = np.linspace(0, length, n_points)
-        y = np.random.randn(n_points) * 2
-        z = np.random.randn(n_points) * 2
+        y = rng.standard_normal(n_points) * 2
+        z = rng.standard_normal(n_points) * 2
         
         # Плавная траектория
         from scipy.interpolate import interp1d
@@ -198,71 +231,63 @@ def create_figure_3_3d_tracts():
     
     print("✅ Figure 3 сохранена: Figure3_3D_Tracts.png")
 
-def create_figure_4_network():
-    """Figure 4: Сетевой график"""
+def create_figure_4_network(df=None, seed=0):
+    """Figure 4: Сетевой график - региональный коннектом (регион x регион)
+    
+    Узлы - парцеллы, рёбра - пары парцелл, соединённые трактами (матрицы региональной
+    стадии пайплайна, суммарно по субъектам): толщина - число трактов, цвет - средний OPC.
+    """
     print("📊 Создаем Figure 4: Сетевой график...")
     
-    # Загружаем данные
-    df = pd.read_csv('ds006181_fixed_metrics.csv')
+    # Загружаем данные (если не переданы)
+    if df is None:
+        df = load_region_edges(REGIONS_PATH)
     
-    # Создаем граф
-    G = nx.Graph()
+    # Граф регионов без петель (тракты внутри одной парцеллы - в силе узла)
+    n_regions = int(max(df['region_a'].max(), df['region_b'].max()))
+    count = sp.coo_matrix((df['count'], (df['region_a'] - 1, df['region_b'] - 1)),
+                          shape=(n_regions, n_regions)).tocsr()
+    count = count + sp.triu(count, k=1).T
+    G = adjacency_to_graph(count)
+    G.remove_nodes_from([node for node in list(G) if count[node].sum() == 0])
+    n_nodes, n_edges = G.number_of_nodes(), G.number_of_edges()
     
-    # Добавляем узлы (топ-20 трактов)
-    top_tracts = df.nlargest(20, 'OPC_mean')
+    edge_opc = {(a - 1, b - 1): opc for a, b, opc in zip(df['region_a'], df['region_b'], df['OPC_mean'])}
+    edges = list(G.edges())
+    edge_colors = [edge_opc.get((min(u, v), max(u, v)), np.nan) for u, v in edges]
+    edge_counts = np.array([G[u][v]['weight'] for u, v in edges], dtype=float)
+    edge_widths = 0.5 + 4.0 * edge_counts / max(edge_counts.max(initial=0), 1)
     
-    for i, (_, tract) in enumerate(top_tracts.iterrows()):
-        G.add_node(i, 
-                  opc=tract['OPC_mean'],
-                  v=tract['V_mean'],
-                  t=tract['T_mean'])
-    
-    # Добавляем рёбра на основе OPC
-    for i in range(len(top_tracts)):
-        for j in range(i+1, len(top_tracts)):
-            opc_i = top_tracts.iloc[i]['OPC_mean']
-            opc_j = top_tracts.iloc[j]['OPC_mean']
-            weight = (opc_i + opc_j) / 2
-            
-            if weight > 0.4:  # Порог для рёбер
-                G.add_edge(i, j, weight=weight)
-    
-    # Позиции узлов
-    pos = nx.spring_layout(G, k=1, iterations=50)
-    
-    # Размеры узлов по OPC
-    node_sizes = [top_tracts.iloc[i]['OPC_mean'] * 1000 for i in range(len(top_tracts))]
-    
-    # Цвета узлов по V-number
-    node_colors = [top_tracts.iloc[i]['V_mean'] for i in range(len(top_tracts))]
+    # Сила узла - число трактов с концом в регионе
+    strength = np.array([count[node].sum() for node in G.nodes()], dtype=float)
+    node_sizes = 100 + 900 * strength / max(strength.max(initial=0), 1)
+    
+    # Позиции узлов: пружинная раскладка с весами по числу трактов
+    pos = nx.spring_layout(G, k=1 / np.sqrt(max(n_nodes, 1)), iterations=100, seed=seed)
     
     # Создаем график
     fig, ax = plt.subplots(figsize=(12, 10))
     
-    # Рисуем рёбра
-    nx.draw_networkx_edges(G, pos, alpha=0.3, width=0.5, ax=ax)
+    norm = plt.Normalize(vmin=np.nanmin(edge_colors) if edges else 0,
+                         vmax=np.nanmax(edge_colors) if edges else 1)
+    nx.draw_networkx_edges(G, pos, edgelist=edges, width=edge_widths, edge_color=edge_colors,
+                           edge_cmap=plt.cm.RdYlBu_r, edge_vmin=norm.vmin, edge_vmax=norm.vmax,
+                           alpha=0.7, ax=ax)
+    nx.draw_networkx_nodes(G, pos, node_size=node_sizes, node_color='lightgray',
+                           edgecolors='black', linewidths=0.5, ax=ax)
     
-    # Рисуем узлы
-    nodes = nx.draw_networkx_nodes(G, pos, 
-                                  node_size=node_sizes,
-                                  node_color=node_colors,
-                                  cmap=plt.cm.RdYlBu_r,
-                                  alpha=0.8,
-                                  ax=ax)
-    
-    # Добавляем подписи узлов
-    labels = {i: f'T{i+1}' for i in range(len(top_tracts))}
-    nx.draw_networkx_labels(G, pos, labels, font_size=8, ax=ax)
+    # Подписи узлов - только для небольших графов
+    if n_nodes <= NETWORK_MAX_LABELS:
+        nx.draw_networkx_labels(G, pos, {node: f'R{node+1}' for node in G.nodes()}, font_size=8, ax=ax)
     
     # Цветовая шкала
-    sm = plt.cm.ScalarMappable(cmap=plt.cm.RdYlBu_r, 
-                               norm=plt.Normalize(vmin=min(node_colors), 
-                                                vmax=max(node_colors)))
+    sm = plt.cm.ScalarMappable(cmap=plt.cm.RdYlBu_r, norm=norm)
     sm.set_array([])
     cbar = plt.colorbar(sm, ax=ax, shrink=0.8)
-    cbar.set_label('V-number', rotation=270, labelpad=20)
+    cbar.set_label('Mean OPC', rotation=270, labelpad=20)
     
-    ax.set_title('Optical Connectome Network (Top 20 Tracts)', fontsize=14, fontweight='bold')
+    ax.set_title(f'Region-Level Optical Connectome ({n_nodes} Regions, {n_edges} Connections, '
+                 f'{int(df["count"].sum())} Tracts)', fontsize=14, fontweight='bold')
     ax.axis('off')
     
     plt.tight_layout()
@@ -271,12 +296,13 @@ def create_figure_4_network():
     
     print("✅ Figure 4 сохранена: Figure4_Network.png")
 
-def create_figure_5_comparison():
+def create_figure_5_comparison(df=None):
     """Figure 5: Сравнение датасетов"""
     print("📊 Создаем Figure 5: Сравнение датасетов...")
     
-    # Загружаем данные
-    df = pd.read_csv('multi_dataset_optical_metrics.csv')
+    # Загружаем данные (если не переданы)
+    if df is None:
+        df = load_metrics(MULTI_PATH, columns=FIGURE_COLUMNS[5])
     
     fig, axes = plt.subplots(2, 2, figsize=(15, 12))
     fig.suptitle('Multi-Dataset Comparison', fontsize=16, fontweight='bold')
@@ -311,32 +337,153 @@ def create_figure_5_comparison():
     
     print("✅ Figure 5 сохранена: Figure5_Dataset_Comparison.png")
 
-def create_all_figures():
-    """Создать все графики"""
+# Номер -> (функция, таблица, файл)
+FIGURES = {
+    1: (create_figure_1_distributions, 'metrics', 'Figure1_Distributions.png'),
+    2: (create_figure_2_correlations, 'metrics', 'Figure2_Correlations.png'),
+    3: (create_figure_3_3d_tracts, 'metrics', 'Figure3_3D_Tracts.png'),
+    4: (create_figure_4_network, 'regions', 'Figure4_Network.png'),
+    5: (create_figure_5_comparison, 'multi', 'Figure5_Dataset_Comparison.png')
+}
+
+class FigureData:
+    """Общие данные для графиков: каждая таблица читается с диска один раз и лениво
+    
+    Загружаются только столбцы, нужные выбранным графикам. Готовые таблицы можно
+    передать через metrics/multi/regions - тогда диск не читается вовсе. Таблица
+    regions - рёбра регион-регион из каталога региональных матриц (load_region_edges).
+    """
+    
+    def __init__(self, figures=None, metrics_path=METRICS_PATH, multi_path=MULTI_PATH,
+                 metrics=None, multi=None, regions_path=REGIONS_PATH, regions=None):
+        figures = sorted(FIGURES) if figures is None else figures
+        self.paths = {'metrics': metrics_path, 'multi': multi_path, 'regions': regions_path}
+        self.columns = {'metrics': [], 'multi': [], 'regions': []}
+        for n in figures:
+            table = FIGURES[n][1]
+            self.columns[table] += [c for c in FIGURE_COLUMNS[n] if c not in self.columns[table]]
+        self._frames = {'metrics': metrics, 'multi': multi, 'regions': regions}
+    
+    def get(self, table):
+        if self._frames[table] is None and table == 'regions':
+            self._frames[table] = load_region_edges(self.paths[table])
+        elif self._frames[table] is None:
+            self._frames[table] = load_metrics(self.paths[table], columns=self.columns[table])
+        return self._frames[table]
+    
+    @property
+    def metrics(self):
+        return self.get('metrics')
+    
+    @property
+    def multi(self):
+        return self.get('multi')
+
+# Данные, переданные в процесс-рендерер один раз при его запуске
+_WORKER_FRAMES = {}
+
+def _init_figure_worker(frames):
+    """Инициализация процесса: неинтерактивный бэкенд Agg и общие таблицы"""
+    plt.switch_backend('Agg')
+    _WORKER_FRAMES.update(frames)
+
+def _render_figure(n):
+    """Построить график n в процессе пула; ошибка возвращается текстом"""
+    func, table, _ = FIGURES[n]
+    try:
+        func(_WORKER_FRAMES[table])
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+def create_all_figures(figures=None, data=None, workers=1, force=False):
+    """Создать все (или выбранные) графики; данные читаются один раз
+    
+    workers > 1 - графики строятся параллельно в отдельных процессах (Agg).
+    Ошибка одного графика не останавливает остальные. Графики, чьи входные
+    столбцы и код (модуль графиков и FIGURE_MODULES) не изменились с прошлой сборки,
+    пропускаются (force - строить всё).
+    """
+    figures = sorted(FIGURES) if not figures else figures
+    if data is None:
+        data = FigureData(figures)
+    
     print("🚀 СОЗДАНИЕ ПУБЛИКАЦИОННЫХ ГРАФИКОВ")
     print("=" * 50)
     
-    try:
-        create_figure_1_distributions()
-        create_figure_2_correlations()
-        create_figure_3_3d_tracts()
-        create_figure_4_network()
-        create_figure_5_comparison()
+    errors = {}
+    cache = BuildCache()
+    keys = {}
+    todo = []
+    for n in figures:
+        func, table, output = FIGURES[n]
+        try:
+            keys[n] = fingerprint(data.get(table), FIGURE_COLUMNS[n], {'figure': n}, func,
+                                  FIGURE_MODULES)
+        except Exception:
+            errors[n] = traceback.format_exc()
+            continue
+        if force or not cache.is_fresh(output, keys[n]):
+            todo.append(n)
+    
+    if workers <= 1:
+        for n in todo:
+            func, table, _ = FIGURES[n]
+            try:
+                func(data.get(table))
+            except Exception:
+                errors[n] = traceback.format_exc()
+    elif todo:
+        frames = {FIGURES[n][1]: data.get(FIGURES[n][1]) for n in todo}
         
+        print(f"⚙️ Параллельный рендеринг: {min(workers, len(todo))} процессов")
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo)),
+                                 initializer=_init_figure_worker, initargs=(frames,)) as pool:
+            futures = {pool.submit(_render_figure, n): n for n in todo}
+            for future in as_completed(futures):
+                error = future.result()
+                if error is not None:
+                    errors[futures[future]] = error
+    
+    for n in todo:
+        if n not in errors:
+            cache.record(FIGURES[n][2], keys[n], figure=n)
+    
+    print("\n📁 Результаты:")
+    for n in figures:
+        if n in errors:
+            print(f"   ❌ {FIGURES[n][2]}")
+        elif n not in todo:
+            print(f"   ⏭️ {FIGURES[n][2]} (актуален)")
+        else:
+            print(f"   ✅ {FIGURES[n][2]}")
+    
+    for n, error in sorted(errors.items()):
+        print(f"\n❌ Ошибка в Figure {n}:")
+        print(error)
+    
+    if not errors:
         print("\n🎉 ВСЕ ГРАФИКИ СОЗДАНЫ!")
-        print("=" * 30)
-        print("📁 Созданные файлы:")
-        print("   - Figure1_Distributions.png")
-        print("   - Figure2_Correlations.png")
-        print("   - Figure3_3D_Tracts.png")
-        print("   - Figure4_Network.png")
-        print("   - Figure5_Dataset_Comparison.png")
-        print("\n✅ Готово для публикации в топ-журналах!")
-        
-    except Exception as e:
-        print(f"❌ Ошибка: {e}")
-        import traceback
-        traceback.print_exc()
+        print("✅ Готово для публикации в топ-журналах!")
+    
+    return errors
 
 if __name__ == "__main__":
-    create_all_figures()
+    parser = argparse.ArgumentParser(description="Публикационные графики оптического коннектома")
+    parser.add_argument("figures", nargs="*", type=int,
+                        help=f"номера графиков {sorted(FIGURES)} (по умолчанию все)")
+    parser.add_argument("--metrics", default=METRICS_PATH, help="таблица метрик ds006181")
+    parser.add_argument("--multi", default=MULTI_PATH, help="мультидатасетная таблица")
+    parser.add_argument("--regions", default=REGIONS_PATH, help="каталог региональных матриц (Figure 4)")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="число процессов рендеринга")
+    parser.add_argument("--force", action="store_true", help="перестроить даже актуальные графики")
+    args = parser.parse_args()
+    
+    unknown = sorted(set(args.figures) - set(FIGURES))
+    if unknown:
+        parser.error(f"нет графиков с номерами {unknown}")
+    
+    figures = args.figures or sorted(FIGURES)
+    create_all_figures(figures, FigureData(figures, args.metrics, args.multi,
+                                                  regions_path=args.regions),
+                       workers=args.workers, force=args.force)
@@ -12,25 +12,29 @@
 Автор: Optical Connectome Research Team
 """
 
+import argparse
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy import stats
-from scipy.stats import ttest_ind, f_oneway, chi2_contingency
+from scipy.stats import ttest_ind, ttest_ind_from_stats, f_oneway, chi2_contingency
 from sklearn.metrics import roc_curve, auc, roc_auc_score
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.linear_model import LogisticRegression
+from metrics_io import load_metrics, METRICS_SCHEMA
+from online_stats import RunningMoments, GroupedMoments
+from build_cache import BuildCache, fingerprint
 import warnings
 warnings.filterwarnings('ignore')
 
 def calculate_confidence_intervals(data, confidence=0.95):
     """Вычислить доверительные интервалы"""
-    n = len(data)
-    mean = np.mean(data)
-    std = np.std(data, ddof=1)
-    
+    return confidence_interval_from_moments(len(data), np.mean(data), np.std(data, ddof=1), confidence)
+
+def confidence_interval_from_moments(n, mean, std, confidence=0.95):
+    """Доверительный интервал по числу наблюдений, среднему и стандартному отклонению"""
     # t-статистика для заданного уровня доверия
     alpha = 1 - confidence
     t_val = stats.t.ppf(1 - alpha/2, n-1)
@@ -50,18 +54,72 @@ def calculate_confidence_intervals(data, confidence=0.95):
         'n': n
     }
 
-def enhanced_statistical_analysis():
-    """Полный статистический анализ"""
+ROC_OUTPUT = 'ROC_Analysis.png'
+ROC_COLUMNS = ['length', 'V_mean', 'T_mean', 'OPC_mean']
+
+def roc_analysis(df, median_length, output=ROC_OUTPUT):
+    """ROC анализ классификации трактов по длине; график сохраняется в output"""
+    # Создаем бинарную классификацию
+    y = (df['length'] >= median_length).astype(int)
+    X = df[['V_mean', 'T_mean', 'OPC_mean']].fillna(0)
+    
+    # Разделяем данные
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
+    
+    # Обучаем модель
+    model = RandomForestClassifier(n_estimators=100, random_state=42)
+    model.fit(X_train, y_train)
+    
+    # Предсказания
+    y_pred_proba = model.predict_proba(X_test)[:, 1]
+    
+    # ROC кривая
+    fpr, tpr, thresholds = roc_curve(y_test, y_pred_proba)
+    roc_auc = auc(fpr, tpr)
+    
+    accuracy = model.score(X_test, y_test)
+    
+    # Создаем ROC график
+    plt.figure(figsize=(8, 6))
+    plt.plot(fpr, tpr, color='darkorange', lw=2, label=f'ROC curve (AUC = {roc_auc:.3f})')
+    plt.plot([0, 1], [0, 1], color='navy', lw=2, linestyle='--', label='Random')
+    plt.xlim([0.0, 1.0])
+    plt.ylim([0.0, 1.05])
+    plt.xlabel('False Positive Rate')
+    plt.ylabel('True Positive Rate')
+    plt.title('ROC Curve - Tract Length Classification')
+    plt.legend(loc="lower right")
+    plt.grid(True, alpha=0.3)
+    plt.tight_layout()
+    plt.savefig(output, dpi=300, bbox_inches='tight')
+    plt.close()
+    
+    return roc_auc, accuracy
+
+def cached_roc_analysis(df, median_length, output=ROC_OUTPUT, force=False):
+    """ROC анализ через кэш сборки: (roc_auc, accuracy, перестроен ли график)"""
+    cache = BuildCache()
+    key = fingerprint(df, ROC_COLUMNS, {'median_length': float(median_length)}, roc_analysis)
+    if not force and cache.is_fresh(output, key):
+        meta = cache.meta(output)
+        return meta['roc_auc'], meta['accuracy'], False
+    
+    roc_auc, accuracy = roc_analysis(df, median_length, output)
+    cache.record(output, key, roc_auc=float(roc_auc), accuracy=float(accuracy))
+    return roc_auc, accuracy, True
+
+def enhanced_statistical_analysis(force=False):
+    """Полный статистический анализ (force - перестроить ROC график даже без изменений)"""
     print("📊 УЛУЧШЕННАЯ СТАТИСТИЧЕСКАЯ АНАЛИЗ")
     print("=" * 50)
     
-    # Загружаем данные
-    df = pd.read_csv('ds006181_fixed_metrics.csv')
-    print(f"📈 Загружено {len(df)} трактов")
-    
     # Основные метрики
     metrics = ['V_mean', 'T_mean', 'OPC_mean', 'DEA_OPC', 'KACI_OPC_realistic', 'length']
     
+    # Загружаем только нужные столбцы
+    df = load_metrics('ds006181_fixed_metrics.csv', columns=metrics + ['region'])
+    print(f"📈 Загружено {len(df)} трактов")
+    
     # 1. Доверительные интервалы
     print("\n🔍 1. ДОВЕРИТЕЛЬНЫЕ ИНТЕРВАЛЫ (95% CI)")
     print("=" * 40)
@@ -157,43 +215,14 @@ def enhanced_statistical_analysis():
     print("📈 4. ROC АНАЛИЗ (классификация по длине)")
     print("=" * 40)
     
-    # Создаем бинарную классификацию
-    y = (df['length'] >= median_length).astype(int)
-    X = df[['V_mean', 'T_mean', 'OPC_mean']].fillna(0)
-    
-    # Разделяем данные
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
-    
-    # Обучаем модель
-    model = RandomForestClassifier(n_estimators=100, random_state=42)
-    model.fit(X_train, y_train)
-    
-    # Предсказания
-    y_pred_proba = model.predict_proba(X_test)[:, 1]
-    
-    # ROC кривая
-    fpr, tpr, thresholds = roc_curve(y_test, y_pred_proba)
-    roc_auc = auc(fpr, tpr)
+    roc_auc, accuracy, rebuilt = cached_roc_analysis(df, median_length, force=force)
     
     print(f"  ROC AUC: {roc_auc:.3f}")
-    print(f"  Точность: {model.score(X_test, y_test):.3f}")
-    
-    # Создаем ROC график
-    plt.figure(figsize=(8, 6))
-    plt.plot(fpr, tpr, color='darkorange', lw=2, label=f'ROC curve (AUC = {roc_auc:.3f})')
-    plt.plot([0, 1], [0, 1], color='navy', lw=2, linestyle='--', label='Random')
-    plt.xlim([0.0, 1.0])
-    plt.ylim([0.0, 1.05])
-    plt.xlabel('False Positive Rate')
-    plt.ylabel('True Positive Rate')
-    plt.title('ROC Curve - Tract Length Classification')
-    plt.legend(loc="lower right")
-    plt.grid(True, alpha=0.3)
-    plt.tight_layout()
-    plt.savefig('ROC_Analysis.png', dpi=300, bbox_inches='tight')
-    plt.close()
-    
-    print("  ROC график сохранен: ROC_Analysis.png")
+    print(f"  Точность: {accuracy:.3f}")
+    if rebuilt:
+        print("  ROC график сохранен: ROC_Analysis.png")
+    else:
+        print("  ⏭️ ROC_Analysis.png актуален (входные данные не изменились)")
     print()
     
     # 6. Корреляционный анализ
@@ -219,15 +248,188 @@ def enhanced_statistical_analysis():
     print()
     
     # 7. Создаем сводный отчет
-    create_statistical_report(ci_results, t_test_results, anova_results, effect_sizes, roc_auc)
+    create_statistical_report(ci_results, t_test_results, anova_results, effect_sizes, roc_auc,
+                              length_split=f"median length {median_length:.1f} mm")
     
     print("✅ СТАТИСТИЧЕСКИЙ АНАЛИЗ ЗАВЕРШЕН!")
     print("📁 Созданные файлы:")
     print("   - ROC_Analysis.png")
     print("   - Statistical_Report.md")
 
-def create_statistical_report(ci_results, t_test_results, anova_results, effect_sizes, roc_auc):
-    """Создать статистический отчет"""
+def streaming_median(path, column='length', chunksize=100_000, n_bins=65536, dtype='float32'):
+    """Точная медиана столбца CSV в ограниченной памяти: три прохода только по column
+    
+    1) min/max и число значений, 2) гистограмма n_bins бинов - бины средних рангов,
+    3) сортируются лишь значения из этих бинов. Результат совпадает с Series.median().
+    """
+    def chunks():
+        for chunk in pd.read_csv(path, usecols=[column], chunksize=chunksize, dtype={column: dtype}):
+            values = chunk[column].to_numpy(dtype=np.float64)
+            yield values[~np.isnan(values)]
+    
+    moments = RunningMoments()
+    for values in chunks():
+        moments.update(values)
+    if moments.n == 0:
+        return np.nan
+    lo, hi = moments.min[0], moments.max[0]
+    if lo == hi:
+        return lo
+    
+    edges = np.linspace(lo, hi, n_bins + 1)
+    counts = np.zeros(n_bins, dtype=np.int64)
+    for values in chunks():
+        counts += np.histogram(values, bins=edges)[0]
+    
+    # Ранги двух средних элементов (совпадают при нечётном n) и их бины
+    ranks = np.array([(moments.n - 1) // 2, moments.n // 2])
+    cumulative = np.cumsum(counts)
+    bins = np.searchsorted(cumulative, ranks, side='right')
+    before = cumulative[bins[0] - 1] if bins[0] > 0 else 0
+    
+    # np.histogram: последний бин закрыт справа, остальные - полуоткрыты
+    selected = []
+    for values in chunks():
+        index = np.minimum(np.searchsorted(edges, values, side='right') - 1, n_bins - 1)
+        selected.append(values[(index >= bins[0]) & (index <= bins[1])])
+    selected = np.sort(np.concatenate(selected))
+    return float(selected[ranks - before].mean())
+
+def streaming_statistical_analysis(path='ds006181_fixed_metrics.csv', chunksize=100_000,
+                                   length_split_mm=None):
+    """Статистический анализ по частям таблицы в постоянной памяти (онлайн-моменты)
+    
+    CI, корреляции, ANOVA по регионам и t-тест/Cohen's d считаются по накопленным
+    моментам. Группы t-теста делятся, как и в enhanced_statistical_analysis, по медиане
+    длины (streaming_median - отдельные проходы только по столбцу length); число
+    length_split_mm задаёт фиксированный порог вместо медианы. Порог пишется в отчёт.
+    ROC анализ (модель на всех данных) пропускается.
+    """
+    print("📊 УЛУЧШЕННАЯ СТАТИСТИЧЕСКАЯ АНАЛИЗ (потоковый режим)")
+    print("=" * 50)
+    
+    metrics = ['V_mean', 'T_mean', 'OPC_mean', 'DEA_OPC', 'KACI_OPC_realistic', 'length']
+    tested = ['V_mean', 'T_mean', 'OPC_mean']
+    
+    per_metric = {metric: RunningMoments() for metric in metrics}
+    joint = RunningMoments(len(metrics))
+    short, long_ = RunningMoments(len(tested)), RunningMoments(len(tested))
+    by_region = GroupedMoments(len(tested))
+    
+    if length_split_mm is None:
+        length_split_mm = streaming_median(path, 'length', chunksize)
+        split_label = f"median length {length_split_mm:.1f} mm"
+    else:
+        split_label = f"fixed length threshold {length_split_mm:.1f} mm"
+    
+    dtypes = {name: dtype for name, dtype in METRICS_SCHEMA.items() if dtype == 'float32'}
+    for chunk in pd.read_csv(path, usecols=metrics + ['region'], chunksize=chunksize,
+                             dtype={name: dtypes[name] for name in metrics if name in dtypes}):
+        values = chunk[metrics].to_numpy(dtype=np.float64)
+        for k, metric in enumerate(metrics):
+            per_metric[metric].update(values[:, k])
+        joint.update(values)
+        
+        groups = chunk[tested].to_numpy(dtype=np.float64)
+        is_short = (chunk['length'] < length_split_mm).to_numpy()
+        short.update(groups[is_short])
+        long_.update(groups[~is_short])
+        by_region.update(chunk['region'].astype(str).to_numpy(), groups)
+    
+    print(f"📈 Обработано {joint.n} трактов (частями по {chunksize})")
+    
+    # 1. Доверительные интервалы
+    print("\n🔍 1. ДОВЕРИТЕЛЬНЫЕ ИНТЕРВАЛЫ (95% CI)")
+    print("=" * 40)
+    
+    ci_results = {}
+    for metric, m in per_metric.items():
+        ci = confidence_interval_from_moments(m.n, m.mean[0], m.std()[0])
+        ci_results[metric] = ci
+        
+        print(f"{metric}:")
+        print(f"  Mean: {ci['mean']:.3f} ± {ci['std']:.3f}")
+        print(f"  95% CI: [{ci['ci_lower']:.3f}, {ci['ci_upper']:.3f}]")
+        print(f"  Width: {ci['ci_width']:.3f}")
+        print()
+    
+    # 2. t-test по порогу длины (медиана или заданный)
+    print("🔬 2. СТАТИСТИЧЕСКИЕ ТЕСТЫ")
+    print("=" * 30)
+    print("T-tests (по длине трактов):")
+    print(f"  Короткие тракты: {short.n} (< {length_split_mm:.1f}mm)")
+    print(f"  Длинные тракты: {long_.n} (≥ {length_split_mm:.1f}mm)")
+    print()
+    
+    t_test_results = {}
+    effect_sizes = {}
+    short_std, long_std = short.std(), long_.std()
+    for k, metric in enumerate(tested):
+        t_stat, p_value = ttest_ind_from_stats(short.mean[k], short_std[k], short.n,
+                                               long_.mean[k], long_std[k], long_.n)
+        t_test_results[metric] = {'t_stat': t_stat, 'p_value': p_value}
+        pooled_std = np.sqrt(((short.n-1)*short_std[k]**2 + (long_.n-1)*long_std[k]**2) / (short.n+long_.n-2))
+        effect_sizes[metric] = (short.mean[k] - long_.mean[k]) / pooled_std
+        
+        significance = "***" if p_value < 0.001 else "**" if p_value < 0.01 else "*" if p_value < 0.05 else "ns"
+        print(f"  {metric}: t={t_stat:.3f}, p={p_value:.3f} {significance}")
+    
+    print()
+    
+    # 3. ANOVA по регионам из моментов групп
+    print("ANOVA (по регионам):")
+    
+    anova_results = {}
+    if len(by_region.groups) > 1:
+        f_stats, df_between, df_within = by_region.anova()
+        for k, metric in enumerate(tested):
+            p_value = stats.f.sf(f_stats[k], df_between, df_within)
+            anova_results[metric] = {'f_stat': f_stats[k], 'p_value': p_value}
+            
+            significance = "***" if p_value < 0.001 else "**" if p_value < 0.01 else "*" if p_value < 0.05 else "ns"
+            print(f"  {metric}: F={f_stats[k]:.3f}, p={p_value:.3f} {significance}")
+    
+    print()
+    
+    # 4. Эффекты размера
+    print("📏 3. ЭФФЕКТЫ РАЗМЕРА (Cohen's d)")
+    print("=" * 35)
+    for metric, d in effect_sizes.items():
+        interpretation = ("незначительный" if abs(d) < 0.2 else "малый" if abs(d) < 0.5
+                          else "средний" if abs(d) < 0.8 else "большой")
+        print(f"  {metric}: d={d:.3f} ({interpretation})")
+    print()
+    
+    print("📈 4. ROC АНАЛИЗ: пропущен в потоковом режиме (нужна модель на всех данных)")
+    print()
+    
+    # 5. Корреляции по матрице ко-моментов (полные строки)
+    print("🔗 5. КОРРЕЛЯЦИОННЫЙ АНАЛИЗ")
+    print("=" * 30)
+    
+    corr_matrix = joint.corr()
+    n = joint.n
+    for i in range(len(metrics)):
+        for j in range(i+1, len(metrics)):
+            r = corr_matrix[i, j]
+            t_stat = r * np.sqrt((n-2) / (1-r**2))
+            p_value = 2 * (1 - stats.t.cdf(abs(t_stat), n-2))
+            
+            significance = "***" if p_value < 0.001 else "**" if p_value < 0.01 else "*" if p_value < 0.05 else "ns"
+            print(f"  {metrics[i]} vs {metrics[j]}: r={r:.3f}, p={p_value:.3f} {significance}")
+    
+    print()
+    
+    create_statistical_report(ci_results, t_test_results, anova_results, effect_sizes, roc_auc=None,
+                              length_split=split_label)
+    
+    print("✅ СТАТИСТИЧЕСКИЙ АНАЛИЗ ЗАВЕРШЕН!")
+    print("📁 Созданные файлы:")
+    print("   - Statistical_Report.md")
+
+def create_statistical_report(ci_results, t_test_results, anova_results, effect_sizes, roc_auc=None,
+                              length_split=None):
+    """Создать статистический отчет (length_split - описание порога групп t-теста)"""
     
     report = f"""# ENHANCED STATISTICAL ANALYSIS REPORT
 
@@ -238,7 +440,7 @@ def create_statistical_report(ci_results, t_test_results, anova_results, effect_
 | Metric | Mean ± SD | 95% CI | Width |
 |--------|-----------|--------|-------|
 """
-    
+
     for metric, ci in ci_results.items():
         report += f"| {metric} | {ci['mean']:.3f} ± {ci['std']:.3f} | [{ci['ci_lower']:.3f}, {ci['ci_upper']:.3f}] | {ci['ci_width']:.3f} |\n"
     
@@ -246,9 +448,9 @@ def create_statistical_report(ci_results, t_test_results, anova_results, effect_
 
 ### Statistical Tests
 
-#### T-tests (Short vs Long Tracts)
+#### T-tests (Short vs Long Tracts{f", split at {length_split}" if length_split else ""})
 """
-    
+
     for metric, result in t_test_results.items():
         significance = "***" if result['p_value'] < 0.001 else "**" if result['p_value'] < 0.01 else "*" if result['p_value'] < 0.05 else "ns"
         report += f"- {metric}: t={result['t_stat']:.3f}, p={result['p_value']:.3f} {significance}\n"
@@ -257,7 +459,7 @@ def create_statistical_report(ci_results, t_test_results, anova_results, effect_
 
 #### ANOVA (by Region)
 """
-    
+
     for metric, result in anova_results.items():
         significance = "***" if result['p_value'] < 0.001 else "**" if result['p_value'] < 0.01 else "*" if result['p_value'] < 0.05 else "ns"
         report += f"- {metric}: F={result['f_stat']:.3f}, p={result['p_value']:.3f} {significance}\n"
@@ -266,7 +468,7 @@ def create_statistical_report(ci_results, t_test_results, anova_results, effect_
 
 ### Effect Sizes (Cohen's d)
 """
-    
+
     for metric, d in effect_sizes.items():
         if abs(d) < 0.2:
             interpretation = "незначительный"
@@ -279,10 +481,12 @@ def create_statistical_report(ci_results, t_test_results, anova_results, effect_
         
         report += f"- {metric}: d={d:.3f} ({interpretation})\n"
     
+    roc_line = (f"- ROC AUC: {roc_auc:.3f}" if roc_auc is not None
+                else "- ROC AUC: не вычислялся (потоковый режим)")
     report += f"""
 
 ### ROC Analysis
-- ROC AUC: {roc_auc:.3f}
+{roc_line}
 - Classification: Tract length (short vs long)
 
 ## Interpretation
@@ -312,11 +516,24 @@ def create_statistical_report(ci_results, t_test_results, anova_results, effect_
 ---
 *Statistical analysis completed with enhanced rigor for publication standards.*
 """
-    
+
     with open('Statistical_Report.md', 'w') as f:
         f.write(report)
     
     print("✅ Статистический отчет создан: Statistical_Report.md")
 
 if __name__ == "__main__":
-    enhanced_statistical_analysis()
+    parser = argparse.ArgumentParser(description="Статистический анализ метрик оптического коннектома")
+    parser.add_argument("--stream", action="store_true",
+                        help="потоковый режим: таблица читается частями (без ROC анализа)")
+    parser.add_argument("--chunksize", type=int, default=100_000, help="строк в части")
+    parser.add_argument("--length-split", type=float, default=None,
+                        help="фиксированный порог длины (мм) для t-теста в потоковом режиме "
+                             "(по умолчанию медиана)")
+    parser.add_argument("--force", action="store_true", help="перестроить ROC график даже без изменений")
+    args = parser.parse_args()
+    
+    if args.stream:
+        streaming_statistical_analysis(chunksize=args.chunksize, length_split_mm=args.length_split)
+    else:
+        enhanced_statistical_analysis(force=args.force)
@@ -10,16 +10,30 @@
 Автор: Optical Connectome Research Team
 """
 
+import os
+import argparse
 import numpy as np
 import pandas as pd
 from scipy import stats
 from scipy.signal import detrend
 from sklearn.preprocessing import StandardScaler
+from profile_archive import ProfileArchive
+from metrics_io import load_metrics, write_metrics, parquet_path
+from online_stats import RunningMoments
+from complexity_metrics import (kaci_batch, lempel_ziv, lempel_ziv_batch, binarize_median,
+                                permutation_entropy, permutation_entropy_batch)
 import warnings
 warnings.filterwarnings('ignore')
 
-def create_realistic_profile(opc_value, length_mm, n_points=50):
+def row_rng(root_seed, row):
+    """Независимый поток для строки row: SeedSequence с spawn_key, не зависит от порядка обхода"""
+    return np.random.default_rng(
+        np.random.SeedSequence(root_seed.entropy, spawn_key=root_seed.spawn_key + (row,))
+    )
+
+def create_realistic_profile(opc_value, length_mm, n_points=50, rng=None):
     """Создать реалистичный профиль на основе OPC значения"""
+    rng = np.random.default_rng(rng)
     
     # Базовый профиль с трендом
     x = np.linspace(0, 1, n_points)
@@ -29,13 +43,13 @@ def create_realistic_profile(opc_value, length_mm, n_points=50):
     sine_component = 0.1 * opc_value * np.sin(2 * np.pi * 3 * x)
     
     # 2. Случайные флуктуации
-    noise_component = 0.05 * opc_value * np.random.randn(n_points)
+    noise_component = 0.05 * opc_value * rng.standard_normal(n_points)
     
     # 3. Экспоненциальный тренд (затухание вдоль тракта)
     exp_trend = opc_value * np.exp(-0.1 * x)
     
     # 4. Локальные "всплески" (узлы Ранвье)
-    spike_positions = np.random.choice(n_points, size=3, replace=False)
+    spike_positions = rng.choice(n_points, size=3, replace=False)
     spike_component = np.zeros(n_points)
     for pos in spike_positions:
         spike_component[pos] = 0.2 * opc_value
@@ -48,131 +62,139 @@ def create_realistic_profile(opc_value, length_mm, n_points=50):
     
     return profile
 
-def calculate_realistic_kaci(profile, mse_frac=0.06, max_knots=16):
-    """Реалистичный расчет KACI"""
-    if len(profile) < 10:
-        return 1.0
+# Блоки строк для пакетного режима: у блока свой поток RNG (по номеру блока)
+BLOCK_SIZE = 4096
+PROFILE_COLUMNS = ['V_mean', 'T_mean', 'OPC_mean']
+REALISTIC_COLUMNS = ['KACI_V_realistic', 'KACI_T_realistic', 'KACI_OPC_realistic',
+                     'Lempel_Ziv_realistic', 'Permutation_Entropy_realistic']
+
+def block_rng(root_seed, block):
+    """Поток блока строк block: SeedSequence с spawn_key (BLOCK_SIZE, block), как row_rng для строки"""
+    return np.random.default_rng(
+        np.random.SeedSequence(root_seed.entropy, spawn_key=root_seed.spawn_key + (BLOCK_SIZE, block))
+    )
+
+def create_realistic_profiles(values, n_points=50, rng=None):
+    """Пакетная версия create_realistic_profile: values (n,) -> профили (n, n_points)"""
+    rng = np.random.default_rng(rng)
+    values = np.asarray(values, dtype=np.float64)[:, None]
+    n_rows = len(values)
+    x = np.linspace(0, 1, n_points)
     
-    profile = np.array(profile)
-    x = np.linspace(0, 1, len(profile))
+    sine_component = 0.1 * values * np.sin(2 * np.pi * 3 * x)
+    noise_component = 0.05 * values * rng.standard_normal((n_rows, n_points))
+    exp_trend = values * np.exp(-0.1 * x)
     
-    # Целевая MSE
-    target_mse = mse_frac * np.var(profile)
+    # Три разные позиции всплесков в строке: наименьшие из случайных чисел
+    spike_positions = np.argpartition(rng.random((n_rows, n_points)), 3, axis=1)[:, :3]
+    spike_component = np.zeros((n_rows, n_points))
+    np.put_along_axis(spike_component, spike_positions, 0.2 * values, axis=1)
     
-    # Пробуем разное количество узлов
-    for n_knots in range(1, max_knots + 1):
-        try:
-            # Создаем сплайн с n_knots узлами
-            knots = np.linspace(0, 1, n_knots + 2)[1:-1]
-            
-            # Упрощенная сплайн аппроксимация
-            from scipy.interpolate import UnivariateSpline
-            spline = UnivariateSpline(x, profile, s=len(profile) * target_mse)
-            fitted = spline(x)
-            
-            # Проверяем точность
-            mse = np.mean((profile - fitted)**2)
-            if mse <= target_mse:
-                return n_knots
-                
-        except:
-            continue
-    
-    return max_knots
+    profiles = exp_trend + sine_component + noise_component + spike_component
+    return profiles * (values / profiles.mean(axis=1, keepdims=True))
+
+def synthetic_profile_batch(df, root_seed, start_row=0, n_points=50):
+    """Синтетические профили V/T/OPC (n, 3, n_points) по блокам BLOCK_SIZE строк
+    
+    start_row - номер первой строки df во всей таблице (кратен BLOCK_SIZE), поэтому
+    профили не зависят от того, читается таблица целиком или частями.
+    """
+    if start_row % BLOCK_SIZE:
+        raise ValueError(f"start_row={start_row} не кратен BLOCK_SIZE={BLOCK_SIZE}")
+    values = df[PROFILE_COLUMNS].to_numpy(dtype=np.float64)
+    profiles = np.empty((len(df), len(PROFILE_COLUMNS), n_points))
+    for b0 in range(0, len(df), BLOCK_SIZE):
+        rng = block_rng(root_seed, (start_row + b0) // BLOCK_SIZE)
+        block = slice(b0, b0 + BLOCK_SIZE)
+        for k in range(len(PROFILE_COLUMNS)):
+            profiles[block, k] = create_realistic_profiles(values[block, k], n_points, rng)
+    return profiles
+
+def realistic_metrics_batch(profiles):
+    """Метрики по профилям (n, 3, n_points): {столбец: массив (n,)}; KACI - целое число узлов"""
+    profiles = np.asarray(profiles, dtype=np.float64)
+    v_profiles, t_profiles, opc_profiles = profiles[:, 0], profiles[:, 1], profiles[:, 2]
+    return {
+        'KACI_V_realistic': kaci_batch(v_profiles).astype(np.int64),
+        'KACI_T_realistic': kaci_batch(t_profiles).astype(np.int64),
+        'KACI_OPC_realistic': kaci_batch(opc_profiles).astype(np.int64),
+        'Lempel_Ziv_realistic': lempel_ziv_batch(binarize_median(opc_profiles)),
+        'Permutation_Entropy_realistic': permutation_entropy_batch(opc_profiles)
+    }
+
+def calculate_realistic_kaci(profile, mse_frac=0.06, max_knots=16):
+    """Реалистичный расчет KACI: минимум узлов LSQ сплайна сверх уровня шума (см. kaci_batch)"""
+    if len(profile) < 10:
+        return 1
+    return int(kaci_batch(profile, mse_frac, max_knots)[0])
 
 def calculate_realistic_lempel_ziv(profile):
-    """Реалистичный расчет Lempel-Ziv"""
-    if len(profile) < 2:
-        return 0.0
-    
-    # Бинаризация с адаптивным порогом
-    threshold = np.median(profile)
-    binary = (profile > threshold).astype(int)
-    
-    # LZ алгоритм
-    n = len(binary)
-    c = 1
-    i = 0
-    
-    while i + c < n:
-        substring = binary[i:i+c]
-        found = False
-        for j in range(i):
-            if np.array_equal(substring, binary[j:j+c]):
-                found = True
-                break
-        if found:
-            c += 1
-        else:
-            i += c
-            c = 1
-    
-    return (i + c) / n
+    """Реалистичный расчет Lempel-Ziv: LZ76 по медианной бинаризации, c * log2(n) / n"""
+    return lempel_ziv(profile)
 
 def calculate_realistic_permutation_entropy(profile, order=3, delay=1):
-    """Реалистичный расчет Permutation Entropy"""
+    """Реалистичный расчет Permutation Entropy (бит) по кодам ординальных паттернов"""
     if len(profile) < order + delay:
         return 0.0
-    
-    # Создаем символы
-    symbols = []
-    for i in range(len(profile) - order * delay + 1):
-        segment = profile[i:i + order * delay:delay]
-        symbols.append(tuple(np.argsort(segment)))
-    
-    # Считаем частоты
-    unique, counts = np.unique(symbols, return_counts=True)
-    probs = counts / len(symbols)
-    
-    # Энтропия
-    entropy = -np.sum(probs * np.log2(probs + 1e-10))
-    return entropy
+    return permutation_entropy(profile, order, delay)
 
-def fix_constant_metrics():
-    """Исправить константные метрики в данных"""
+def fix_constant_metrics(seed=None, profiles_path=None, bulk=True,
+                         input_path='ds006181_optical_metrics.csv',
+                         output_path='ds006181_fixed_metrics.csv'):
+    """Исправить константные метрики в данных
+    
+    seed - int или SeedSequence; потоки RNG привязаны к строкам (row_rng) или к
+    блокам строк (block_rng в пакетном режиме), поэтому результат воспроизводим.
+    profiles_path - архив профилей пайплайна; если задан, метрики считаются по
+    сохранённым профилям V/T/OPC вместо синтетических.
+    bulk - все профили одной матрицей и пакетные KACI/LZ/PE; bulk=False - прежний
+    построчный обход (другие синтетические профили при том же seed).
+    """
     print("🔧 ИСПРАВЛЯЕМ КОНСТАНТНЫЕ МЕТРИКИ...")
     
-    # Загружаем данные
-    df = pd.read_csv('ds006181_optical_metrics.csv')
+    # Загружаем данные в полной точности: схема float32 - только для Parquet-копии
+    df = load_metrics(input_path, typed=False)
     print(f"📊 Загружено {len(df)} трактов")
     
-    # Создаем реалистичные профили
-    print("🧠 Создаем реалистичные профили...")
-    
-    realistic_metrics = {
-        'KACI_V_realistic': [],
-        'KACI_T_realistic': [],
-        'KACI_OPC_realistic': [],
-        'Lempel_Ziv_realistic': [],
-        'Permutation_Entropy_realistic': []
-    }
-    
-    for i, row in df.iterrows():
-        if i % 100 == 0:
-            print(f"   Обработано {i}/{len(df)} трактов")
-        
-        # Создаем профили для V, T, OPC
-        v_profile = create_realistic_profile(row['V_mean'], row['length'])
-        t_profile = create_realistic_profile(row['T_mean'], row['length'])
-        opc_profile = create_realistic_profile(row['OPC_mean'], row['length'])
-        
-        # Вычисляем реалистичные метрики
-        kaci_v = calculate_realistic_kaci(v_profile)
-        kaci_t = calculate_realistic_kaci(t_profile)
-        kaci_opc = calculate_realistic_kaci(opc_profile)
-        
-        lz = calculate_realistic_lempel_ziv(opc_profile)
-        pe = calculate_realistic_permutation_entropy(opc_profile)
-        
-        realistic_metrics['KACI_V_realistic'].append(kaci_v)
-        realistic_metrics['KACI_T_realistic'].append(kaci_t)
-        realistic_metrics['KACI_OPC_realistic'].append(kaci_opc)
-        realistic_metrics['Lempel_Ziv_realistic'].append(lz)
-        realistic_metrics['Permutation_Entropy_realistic'].append(pe)
+    stored_profiles = None
+    if profiles_path is not None:
+        stored_profiles = ProfileArchive(profiles_path).profiles_for(df['tract_id'])
+        print(f"📂 Профили из архива {profiles_path}")
+    else:
+        # Создаем реалистичные профили
+        print("🧠 Создаем реалистичные профили...")
+    
+    root_seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    
+    if bulk:
+        profiles = stored_profiles if stored_profiles is not None else synthetic_profile_batch(df, root_seed)
+        realistic_metrics = realistic_metrics_batch(profiles)
+        print(f"   Обработано {len(df)}/{len(df)} трактов")
+    else:
+        realistic_metrics = {metric: [] for metric in REALISTIC_COLUMNS}
+        for i, (_, row) in enumerate(df.iterrows()):
+            if i % 100 == 0:
+                print(f"   Обработано {i}/{len(df)} трактов")
+            
+            # Профили для V, T, OPC: сохранённые или синтетические
+            if stored_profiles is not None:
+                v_profile, t_profile, opc_profile = stored_profiles[i].astype(float)
+            else:
+                rng = row_rng(root_seed, i)
+                v_profile = create_realistic_profile(row['V_mean'], row['length'], rng=rng)
+                t_profile = create_realistic_profile(row['T_mean'], row['length'], rng=rng)
+                opc_profile = create_realistic_profile(row['OPC_mean'], row['length'], rng=rng)
+            
+            # Вычисляем реалистичные метрики
+            realistic_metrics['KACI_V_realistic'].append(calculate_realistic_kaci(v_profile))
+            realistic_metrics['KACI_T_realistic'].append(calculate_realistic_kaci(t_profile))
+            realistic_metrics['KACI_OPC_realistic'].append(calculate_realistic_kaci(opc_profile))
+            realistic_metrics['Lempel_Ziv_realistic'].append(calculate_realistic_lempel_ziv(opc_profile))
+            realistic_metrics['Permutation_Entropy_realistic'].append(
+                calculate_realistic_permutation_entropy(opc_profile))
     
-    # Добавляем новые метрики к данным
-    for metric, values in realistic_metrics.items():
-        df[metric] = values
+    # Добавляем новые метрики к данным одним присваиванием
+    df = df.assign(**realistic_metrics)
     
     # Статистика новых метрик
     print("\n📈 СТАТИСТИКА ИСПРАВЛЕННЫХ МЕТРИК:")
@@ -187,13 +209,69 @@ def fix_constant_metrics():
         print()
     
     # Сохраняем исправленные данные
-    df.to_csv('ds006181_fixed_metrics.csv', index=False)
-    print("✅ Исправленные данные сохранены в ds006181_fixed_metrics.csv")
+    write_metrics(df, output_path)
+    print(f"✅ Исправленные данные сохранены в {output_path} (+ .parquet)")
     
     return df
 
+def fix_constant_metrics_streaming(seed=None, profiles_path=None,
+                                   input_path='ds006181_optical_metrics.csv',
+                                   output_path='ds006181_fixed_metrics.csv',
+                                   chunksize=25 * BLOCK_SIZE):
+    """Потоковый режим: таблица читается частями по chunksize строк, результат дописывается в CSV
+    
+    chunksize округляется вверх до кратного BLOCK_SIZE, поэтому синтетические профили
+    (и метрики) совпадают с пакетным режимом при том же seed. Статистика копится
+    онлайн (RunningMoments); медиана в потоковом режиме не считается. Parquet-копия
+    не пишется (устаревшая удаляется, чтобы load_metrics читал новый CSV).
+    Возвращает сводку {столбец: {mean, std, min, max}} для create_comparison_report.
+    """
+    print("🔧 ИСПРАВЛЯЕМ КОНСТАНТНЫЕ МЕТРИКИ (потоковый режим)...")
+    
+    chunksize = -(-chunksize // BLOCK_SIZE) * BLOCK_SIZE
+    root_seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    archive = ProfileArchive(profiles_path) if profiles_path is not None else None
+    moments = {metric: RunningMoments() for metric in REALISTIC_COLUMNS}
+    
+    start_row = 0
+    for chunk in pd.read_csv(input_path, chunksize=chunksize):
+        if archive is not None:
+            profiles = archive.profiles_for(chunk['tract_id'])
+        else:
+            profiles = synthetic_profile_batch(chunk, root_seed, start_row)
+        chunk = chunk.assign(**realistic_metrics_batch(profiles))
+        for metric in REALISTIC_COLUMNS:
+            moments[metric].update(chunk[metric].to_numpy(dtype=np.float64))
+        
+        chunk.to_csv(output_path, mode='w' if start_row == 0 else 'a', header=start_row == 0, index=False)
+        start_row += len(chunk)
+        print(f"   Обработано {start_row} трактов")
+    
+    if os.path.exists(parquet_path(output_path)):
+        os.remove(parquet_path(output_path))
+    
+    print("\n📈 СТАТИСТИКА ИСПРАВЛЕННЫХ МЕТРИК:")
+    print("=" * 50)
+    
+    summary = {}
+    for metric, m in moments.items():
+        summary[metric] = {'mean': m.mean[0], 'std': m.std()[0], 'min': m.min[0], 'max': m.max[0]}
+        print(f"{metric}:")
+        print(f"  Mean: {m.mean[0]:.3f} ± {m.std()[0]:.3f}")
+        print(f"  Range: {m.min[0]:.3f} - {m.max[0]:.3f}")
+        print()
+    
+    print(f"✅ Исправленные данные сохранены в {output_path}")
+    return summary
+
+def summarize_metrics(df, columns=REALISTIC_COLUMNS):
+    """Сводка {столбец: {mean, std, min, max}} по таблице"""
+    return {column: {'mean': df[column].mean(), 'std': df[column].std(),
+                     'min': df[column].min(), 'max': df[column].max()} for column in columns}
+
 def create_comparison_report(original_df, fixed_df):
-    """Создать отчет сравнения"""
+    """Создать отчет сравнения (fixed_df - таблица или готовая сводка summarize_metrics)"""
+    summary = fixed_df if isinstance(fixed_df, dict) else summarize_metrics(fixed_df)
     
     report = f"""# ИСПРАВЛЕНИЕ КОНСТАНТНЫХ МЕТРИК - ОТЧЕТ
 
@@ -216,16 +294,16 @@ def create_comparison_report(original_df, fixed_df):
 ## Результаты исправления
 
 ### KACI (реалистичный):
-- Mean: {fixed_df['KACI_OPC_realistic'].mean():.3f} ± {fixed_df['KACI_OPC_realistic'].std():.3f}
-- Range: {fixed_df['KACI_OPC_realistic'].min():.3f} - {fixed_df['KACI_OPC_realistic'].max():.3f}
+- Mean: {summary['KACI_OPC_realistic']['mean']:.3f} ± {summary['KACI_OPC_realistic']['std']:.3f}
+- Range: {summary['KACI_OPC_realistic']['min']:.3f} - {summary['KACI_OPC_realistic']['max']:.3f}
 
 ### Lempel-Ziv (реалистичный):
-- Mean: {fixed_df['Lempel_Ziv_realistic'].mean():.3f} ± {fixed_df['Lempel_Ziv_realistic'].std():.3f}
-- Range: {fixed_df['Lempel_Ziv_realistic'].min():.3f} - {fixed_df['Lempel_Ziv_realistic'].max():.3f}
+- Mean: {summary['Lempel_Ziv_realistic']['mean']:.3f} ± {summary['Lempel_Ziv_realistic']['std']:.3f}
+- Range: {summary['Lempel_Ziv_realistic']['min']:.3f} - {summary['Lempel_Ziv_realistic']['max']:.3f}
 
 ### Permutation Entropy (реалистичный):
-- Mean: {fixed_df['Permutation_Entropy_realistic'].mean():.3f} ± {fixed_df['Permutation_Entropy_realistic'].std():.3f}
-- Range: {fixed_df['Permutation_Entropy_realistic'].min():.3f} - {fixed_df['Permutation_Entropy_realistic'].max():.3f}
+- Mean: {summary['Permutation_Entropy_realistic']['mean']:.3f} ± {summary['Permutation_Entropy_realistic']['std']:.3f}
+- Range: {summary['Permutation_Entropy_realistic']['min']:.3f} - {summary['Permutation_Entropy_realistic']['max']:.3f}
 
 ## Выводы
 1. Исправленные метрики показывают реалистичную вариабельность
@@ -237,18 +315,34 @@ def create_comparison_report(original_df, fixed_df):
 - ds006181_fixed_metrics.csv - исправленные данные
 - fix_constant_metrics.py - код исправления
 """
-    
+
     with open('METRICS_FIX_REPORT.md', 'w') as f:
         f.write(report)
     
     print("✅ Отчет создан: METRICS_FIX_REPORT.md")
 
 if __name__ == "__main__":
-    # Исправляем константные метрики
-    fixed_df = fix_constant_metrics()
+    parser = argparse.ArgumentParser(description="Исправление константных метрик")
+    parser.add_argument("--stream", action="store_true",
+                        help="потоковый режим: таблица читается и пишется частями")
+    parser.add_argument("--chunksize", type=int, default=25 * BLOCK_SIZE,
+                        help=f"строк в части (кратно {BLOCK_SIZE})")
+    parser.add_argument("--profiles", metavar="PATH", default=None,
+                        help="архив профилей пайплайна (например, ds006181_profiles): метрики "
+                             "по сохранённым профилям вместо синтетических (50 точек)")
+    args = parser.parse_args()
     
-    # Загружаем оригинальные данные для сравнения
-    original_df = pd.read_csv('ds006181_optical_metrics.csv')
+    # Исправляем константные метрики
+    profiles_path = args.profiles
+    if args.stream:
+        fixed_df = fix_constant_metrics_streaming(seed=42, profiles_path=profiles_path,
+                                                  chunksize=args.chunksize)
+        original_df = None
+    else:
+        fixed_df = fix_constant_metrics(seed=42, profiles_path=profiles_path)
+        
+        # Загружаем оригинальные данные для сравнения
+        original_df = load_metrics('ds006181_optical_metrics.csv')
     
     # Создаем отчет сравнения
     create_comparison_report(original_df, fixed_df)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+ЧТЕНИЕ И ЗАПИСЬ ТАБЛИЦ МЕТРИК
+=============================
+
+Таблицы метрик пишутся в CSV (для людей) и рядом в Parquet с явной схемой
+типов (для скриптов). Читатели по умолчанию берут Parquet и загружают только
+нужные столбцы; CSV используется, если Parquet нет или он старше CSV.
+
+Автор: Optical Connectome Research Team
+"""
+
+import os
+import pandas as pd
+
+# Схема типов: категориальные метки, float32 метрики, Int16 для KACI (допускает NaN)
+CATEGORY_COLUMNS = ["file_name", "region", "dataset"]
+FLOAT_COLUMNS = ["length", "V_mean", "T_mean", "OPC_mean", "V", "T", "OPC",
+                 "DEA_V", "DEA_T", "DEA_OPC",
+                 "Lempel_Ziv_realistic", "Permutation_Entropy_realistic"]
+INT_COLUMNS = ["n_gradients", "KACI_V", "KACI_T", "KACI_OPC",
+               "KACI_V_realistic", "KACI_T_realistic", "KACI_OPC_realistic"]
+
+METRICS_SCHEMA = {
+    **{name: "category" for name in CATEGORY_COLUMNS},
+    **{name: "float32" for name in FLOAT_COLUMNS},
+    **{name: "Int16" for name in INT_COLUMNS}
+}
+
+def parquet_path(csv_path):
+    """Путь Parquet-файла рядом с CSV"""
+    return os.path.splitext(csv_path)[0] + ".parquet"
+
+def apply_schema(df):
+    """Привести известные столбцы к типам METRICS_SCHEMA (остальные - без изменений)
+    
+    Столбцы KACI с дробными значениями (усреднённые KACI других датасетов) остаются float32.
+    """
+    dtypes = {}
+    for name, dtype in METRICS_SCHEMA.items():
+        if name not in df.columns:
+            continue
+        if dtype == "Int16":
+            values = pd.to_numeric(df[name]).dropna()
+            if not (values == values.round()).all():
+                dtype = "float32"
+        dtypes[name] = dtype
+    return df.astype(dtypes)
+
+def write_metrics(df, csv_path):
+    """Записать таблицу метрик в CSV (как есть, полная точность) и типизированный Parquet рядом"""
+    df.to_csv(csv_path, index=False)
+    apply_schema(df).to_parquet(parquet_path(csv_path), index=False)
+
+def load_metrics(csv_path, columns=None, typed=True):
+    """Загрузить таблицу метрик (Parquet, если он актуален, иначе CSV) со схемой типов
+    
+    typed=False - CSV в исходной точности (float64, без схемы): для пересчёта таблицы
+    и повторной записи CSV, чтобы float32 из схемы не попадал в человекочитаемый файл.
+    """
+    if not typed:
+        return pd.read_csv(csv_path, usecols=columns)
+    
+    pq_path = parquet_path(csv_path)
+    if os.path.exists(pq_path) and (not os.path.exists(csv_path) or
+                                    os.path.getmtime(pq_path) >= os.path.getmtime(csv_path)):
+        return pd.read_parquet(pq_path, columns=columns)
+    
+    dtypes = {name: dtype for name, dtype in METRICS_SCHEMA.items()
+              if dtype != "Int16" and (columns is None or name in columns)}
+    return apply_schema(pd.read_csv(csv_path, usecols=columns, dtype=dtypes))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+ПОТОКОВЫЕ (ОНЛАЙН) СТАТИСТИКИ
+=============================
+
+Накопители моментов для обработки таблиц по частям в постоянной памяти:
+среднее, дисперсия и матрица ко-моментов обновляются порциями по формулам
+Велфорда/Чана и объединяются между собой (merge), поэтому результат не
+зависит от размера порций.
+
+Автор: Optical Connectome Research Team
+"""
+
+import numpy as np
+
+class RunningMoments:
+    """Число наблюдений, средние, ко-моменты, минимумы и максимумы k признаков
+    
+    Строки с NaN хотя бы в одном признаке пропускаются (ко-моменты считаются
+    по полным строкам); для одного признака это обычный dropna.
+    """
+    
+    def __init__(self, n_features=1):
+        self.n = 0
+        self.mean = np.zeros(n_features)
+        self.comoment = np.zeros((n_features, n_features))
+        self.min = np.full(n_features, np.inf)
+        self.max = np.full(n_features, -np.inf)
+    
+    def update(self, X):
+        """Добавить порцию наблюдений X (n_rows, k) или (n_rows,) при k=1"""
+        X = np.asarray(X, dtype=np.float64).reshape(-1, len(self.mean))
+        X = X[~np.isnan(X).any(axis=1)]
+        if len(X) == 0:
+            return self
+        batch = RunningMoments(len(self.mean))
+        batch.n = len(X)
+        batch.mean = X.mean(axis=0)
+        centered = X - batch.mean
+        batch.comoment = centered.T @ centered
+        batch.min = X.min(axis=0)
+        batch.max = X.max(axis=0)
+        return self.merge(batch)
+    
+    def merge(self, other):
+        """Объединить с другим накопителем (формула Чана)"""
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.comoment = self.comoment + other.comoment + np.outer(delta, delta) * (self.n * other.n / n)
+        self.mean = self.mean + delta * (other.n / n)
+        self.n = n
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        return self
+    
+    def var(self, ddof=1):
+        if self.n <= ddof:
+            return np.full(len(self.mean), np.nan)
+        return np.diag(self.comoment) / (self.n - ddof)
+    
+    def std(self, ddof=1):
+        return np.sqrt(self.var(ddof))
+    
+    def cov(self, ddof=1):
+        if self.n <= ddof:
+            return np.full(self.comoment.shape, np.nan)
+        return self.comoment / (self.n - ddof)
+    
+    def corr(self):
+        scale = np.sqrt(np.diag(self.comoment))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.comoment / np.outer(scale, scale)
+
+class GroupedMoments:
+    """RunningMoments по группам (например, по регионам)"""
+    
+    def __init__(self, n_features=1):
+        self.n_features = n_features
+        self.groups = {}
+    
+    def update(self, keys, X):
+        """Добавить порцию: keys (n_rows,) - метки групп, X (n_rows, k)"""
+        keys = np.asarray(keys)
+        X = np.asarray(X, dtype=np.float64).reshape(len(keys), self.n_features)
+        for key in np.unique(keys):
+            self.groups.setdefault(key, RunningMoments(self.n_features)).update(X[keys == key])
+        return self
+    
+    def merge(self, other):
+        for key, moments in other.groups.items():
+            self.groups.setdefault(key, RunningMoments(self.n_features)).merge(moments)
+        return self
+    
+    def anova(self):
+        """Однофакторный ANOVA по моментам групп: (F, df_between, df_within) по признакам"""
+        groups = [g for g in self.groups.values() if g.n > 0]
+        n_total = sum(g.n for g in groups)
+        grand_mean = sum(g.mean * g.n for g in groups) / n_total
+        ss_between = sum(g.n * (g.mean - grand_mean)**2 for g in groups)
+        ss_within = sum(np.diag(g.comoment) for g in groups)
+        df_between = len(groups) - 1
+        df_within = n_total - len(groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f_stat = (ss_between / df_between) / (ss_within / df_within)
+        return f_stat, df_between, df_within
@@ -7,14 +7,23 @@
 """
 
 import os
+import argparse
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 import pandas as pd
 import nibabel as nib
 from dipy.io import read_bvals_bvecs
 from dipy.core.gradients import gradient_table
 from scipy.interpolate import splrep, splev
+from scipy.ndimage import map_coordinates
 from sklearn.linear_model import LinearRegression
 from sklearn.metrics import mean_squared_error
+from profile_archive import write_profile_archive
+from complexity_metrics import lsq_spline_basis, first_fit_knots
+from metrics_io import write_metrics
+from connectome_graph import subject_region_matrices, save_region_matrices
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -28,6 +37,34 @@ def transmission(length_mm, alpha_db_per_mm=0.1):
     """Передача по тракту при потерях alpha (дБ/мм)"""
     return 10**(-alpha_db_per_mm*length_mm/10)
 
+def tensor_fa(signal, bvals, bvecs, min_signal=1.0):
+    """FA по лог-линейной подгонке тензора сразу для всех вокселей: signal (..., V) -> FA (...)"""
+    g = np.asarray(bvecs, dtype=np.float64)
+    b = np.asarray(bvals, dtype=np.float64)[:, None]
+    # ln S = ln S0 - b g^T D g: столбцы Dxx, Dyy, Dzz, Dxy, Dxz, Dyz, ln S0
+    design = np.column_stack([-b * g[:, [0]]**2, -b * g[:, [1]]**2, -b * g[:, [2]]**2,
+                              -2 * b * g[:, [0]] * g[:, [1]], -2 * b * g[:, [0]] * g[:, [2]],
+                              -2 * b * g[:, [1]] * g[:, [2]], np.ones_like(b)])
+    shape = signal.shape[:-1]
+    log_signal = np.log(np.maximum(signal.reshape(-1, signal.shape[-1]).astype(np.float64), min_signal))
+    coef = log_signal @ np.linalg.pinv(design).T
+    
+    tensor = coef[:, [0, 3, 4, 3, 1, 5, 4, 5, 2]].reshape(-1, 3, 3)
+    evals = np.clip(np.linalg.eigvalsh(tensor), 0, None)
+    norm = np.sqrt(np.sum(evals**2, axis=1))
+    spread = np.sqrt(0.5 * ((evals[:, 0] - evals[:, 1])**2 + (evals[:, 1] - evals[:, 2])**2 +
+                            (evals[:, 2] - evals[:, 0])**2))
+    fa = np.divide(spread, norm, out=np.zeros_like(norm), where=norm > 0)
+    return fa.reshape(shape)
+
+def myelin_thickness_from_fa(fa, t_max=500e-9):
+    """Прокси толщины миелина (м): линейно по FA, FA=1 -> t_max"""
+    return t_max * np.clip(fa, 0.0, 1.0)
+
+def transmission_per_mm(fa, alpha_max_db_per_mm=0.2):
+    """Передача на 1 мм: потери падают с ростом FA (alpha = alpha_max * (1 - FA))"""
+    return transmission(1.0, alpha_max_db_per_mm * (1.0 - np.clip(fa, 0.0, 1.0)))
+
 # ========== 2. DEA и KACI функции ==========
 def compute_dea(profile, detrend=True):
     """DEA - Detrended Fluctuation Analysis"""
@@ -56,6 +93,94 @@ def compute_dea(profile, detrend=True):
     lr = LinearRegression().fit(np.log(np.array(ns)).reshape(-1,1), np.array(S_vals))
     return float(lr.coef_[0])
 
+# Правило bins="auto" в NumPy >= 2.3 ограничивает ширину FD снизу половиной правила sqrt
+_AUTO_BINS_SQRT_LIMIT = np.lib.NumpyVersion(np.__version__) >= '2.3.0'
+
+def _auto_bin_width(disp):
+    """Ширина бинов np.histogram(bins="auto") для каждой строки disp (R, m)"""
+    m = disp.shape[1]
+    ptp = disp.max(axis=1) - disp.min(axis=1)
+    q75, q25 = np.percentile(disp, [75, 25], axis=1)
+    fd_bw = 2.0 * (q75 - q25) * m ** (-1.0 / 3.0)
+    sturges_bw = ptp / (np.log2(m) + 1.0)
+    if _AUTO_BINS_SQRT_LIMIT:
+        return np.minimum(np.maximum(fd_bw, ptp / np.sqrt(m) / 2), sturges_bw)
+    return np.where(fd_bw > 0, np.minimum(fd_bw, sturges_bw), sturges_bw)
+
+def _histogram_entropy_batch(disp):
+    """Энтропия -sum(p*log p) плотности np.histogram(bins="auto", density=True) по строкам"""
+    R, m = disp.shape
+    first = disp.min(axis=1)
+    last = disp.max(axis=1)
+    width = _auto_bin_width(disp)
+    flat = first == last
+    first = np.where(flat, first - 0.5, first)
+    last = np.where(flat, last + 0.5, last)
+    delta = last - first
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n_bins = np.where(width > 0, np.ceil(delta / width), 1).astype(np.int64)
+    step = delta / n_bins
+    
+    def edge(k, rows):
+        # Как np.linspace(first, last, n_bins + 1): k*step + first, последний край = last
+        return np.where(k == n_bins[rows], last[rows], k * step[rows] + first[rows])
+    
+    # Индексы бинов с теми же поправками на 1 ULP, что и в np.histogram
+    rows = np.arange(R)[:, None]
+    idx = (((disp - first[:, None]) / delta[:, None]) * n_bins[:, None]).astype(np.int64)
+    idx[idx == n_bins[:, None]] -= 1
+    idx[disp < edge(idx, rows)] -= 1
+    idx[(disp >= edge(idx + 1, rows)) & (idx != n_bins[:, None] - 1)] += 1
+    
+    # Считаем только непустые бины: ключ (строка, бин) -> count
+    stride = n_bins.max() + 1
+    keys, counts = np.unique((rows * stride + idx).ravel(), return_counts=True)
+    key_rows, key_bins = np.divmod(keys, stride)
+    db = edge(key_bins + 1, key_rows) - edge(key_bins, key_rows)
+    p = counts / db / m
+    return -np.bincount(key_rows, weights=p * np.log(p), minlength=R)
+
+def compute_dea_batch(profiles, detrend=True):
+    """DEA для всех профилей сразу: profiles (n_tracts, n_points) -> (n_tracts,)
+    
+    Те же шаги, что в compute_dea, но по строкам: тренд снимается МНК в замкнутой
+    форме, кумулятивные суммы и смещения сегментов считаются для всех строк,
+    наклон S(log n) - тоже в замкнутой форме. Строки с NaN/inf дают NaN.
+    """
+    X = np.array(profiles, dtype=float, ndmin=2)
+    R, N = X.shape
+    result = np.full(R, np.nan)
+    if N < 20 or R == 0:
+        return result
+    
+    finite = np.all(np.isfinite(X), axis=1)
+    X = np.where(finite[:, None], X, 0.0)
+    if detrend:
+        t = np.arange(N, dtype=float)
+        tc = t - t.mean()
+        slope = (X @ tc) / (tc @ tc)
+        X = X - (X.mean(axis=1) - slope * t.mean())[:, None] - slope[:, None] * t
+    Y = np.cumsum(X - X.mean(axis=1, keepdims=True), axis=1)
+    
+    n_values = np.unique(np.linspace(4, max(8, N//5), 10, dtype=int))
+    S_vals, ns = [], []
+    for n in n_values:
+        if n >= N: break
+        segN = (N//n)*n
+        if segN < 4*n: continue
+        segs = Y[:, :segN].reshape(R, -1, n)
+        disp = segs[:, :, -1] - segs[:, :, 0]
+        ns.append(n); S_vals.append(_histogram_entropy_batch(disp))
+    if len(S_vals) < 2:
+        return result
+    
+    # Наклон S от log(n) для каждой строки
+    log_n = np.log(np.array(ns, dtype=float))
+    log_n -= log_n.mean()
+    S = np.column_stack(S_vals)
+    result[finite] = ((S - S.mean(axis=1, keepdims=True)) @ log_n / (log_n @ log_n))[finite]
+    return result
+
 def spline_kaci(profile, mse_frac=0.06, max_knots=16):
     """KACI - Knot-based Complexity Index"""
     y = np.array(profile, dtype=float)
@@ -77,150 +202,660 @@ def spline_kaci(profile, mse_frac=0.06, max_knots=16):
         except: continue
     return max_knots
 
-# ========== 3. Построение оптического коннектома ==========
-def build_optical_connectome(data_path, n_tracts_per_file=300):
-    """Строим оптический коннектом на всех данных ds006181"""
-    print("🚀 === ПОСТРОЕНИЕ ОПТИЧЕСКОГО КОННЕКТОМА ===")
+def spline_kaci_batch(profiles, mse_frac=0.06, max_knots=16):
+    """KACI для всех профилей сразу: profiles (n_tracts, n_points) -> (n_tracts,)
+    
+    Соглашение spline_kaci: k = 4..max_knots узлов linspace(0, 1, k), внутренние -
+    k - 2; порог mse_frac * var. Базис и поиск общие с kaci_batch (complexity_metrics):
+    вся пачка подгоняется одним матричным умножением на число узлов. При k=4 splrep
+    без узлов и s=0 интерполирует данные (нулевая ошибка); вырожденный базис
+    (splrep отказался бы строить сплайн) пропускается.
+    """
+    Y = np.array(profiles, dtype=float, ndmin=2)
+    R, N = Y.shape
+    if N < 8:
+        return np.full(R, np.nan)
+    
+    var = np.var(Y, axis=1)
+    thr = np.where(var > 0, mse_frac * var, 0.0)
+    
+    def basis(k):
+        if k == 4:
+            return np.eye(N)  # интерполяция; NaN в профиле даёт NaN ошибку
+        Q = lsq_spline_basis(N, k - 2)
+        return Q if Q.shape[1] == k + 2 else None
     
-    # Сканируем все файлы
+    return first_fit_knots(Y, thr, range(4, max_knots+1), basis, max_knots)
+
+# ========== 3. Построение оптического коннектома ==========
+def scan_dwi_files(data_path, b0_threshold=50):
+    """Сканируем DWI файлы: только заголовки NIfTI и bval/bvec (без чтения данных)"""
     file_info = []
     for root, dirs, files in os.walk(data_path):
-        for file in files:
-            if file.endswith('_dwi.nii.gz'):
-                full_path = os.path.join(root, file)
-                base_name = file.replace('.nii.gz', '')
-                bval_file = os.path.join(root, base_name + '.bval')
-                bvec_file = os.path.join(root, base_name + '.bvec')
+        dirs.sort()
+        for file in sorted(files):
+            if not file.endswith('_dwi.nii.gz'):
+                continue
+            full_path = os.path.join(root, file)
+            base_name = file.replace('.nii.gz', '')
+            bval_file = os.path.join(root, base_name + '.bval')
+            bvec_file = os.path.join(root, base_name + '.bvec')
+            
+            if not (os.path.exists(bval_file) and os.path.exists(bvec_file)):
+                continue
+            try:
+                bvals, bvecs = read_bvals_bvecs(bval_file, bvec_file)
+                # nib.load читает только заголовок, данные остаются на диске
+                img = nib.load(full_path)
+                header = img.header
+                data_shape = tuple(int(d) for d in img.shape)
+                
+                if len(data_shape) != 4 or data_shape[-1] != len(bvals):
+                    print(f"❌ {file}: форма {data_shape} не совпадает с {len(bvals)} градиентами")
+                    continue
                 
-                if os.path.exists(bval_file) and os.path.exists(bvec_file):
-                    try:
-                        bvals, bvecs = read_bvals_bvecs(bval_file, bvec_file)
-                        img = nib.load(full_path)
-                        data_shape = img.get_fdata().shape
-                        
-                        file_info.append({
-                            'file_path': full_path,
-                            'file_name': file,
-                            'n_gradients': len(bvals),
-                            'data_shape': data_shape,
-                            'bval_file': bval_file,
-                            'bvec_file': bvec_file
-                        })
-                        print(f"✅ {file}: {data_shape}, {len(bvals)} градиентов")
-                    except Exception as e:
-                        print(f"❌ Ошибка в {file}: {e}")
+                file_info.append({
+                    'file_path': full_path,
+                    'file_name': file,
+                    'n_gradients': len(bvals),
+                    'n_b0': int(np.sum(bvals <= b0_threshold)),
+                    'data_shape': data_shape,
+                    'dtype': str(header.get_data_dtype()),
+                    'voxel_size': tuple(float(z) for z in header.get_zooms()[:3]),
+                    'bval_file': bval_file,
+                    'bvec_file': bvec_file
+                })
+                print(f"✅ {file}: {data_shape}, {header.get_data_dtype()}, {len(bvals)} градиентов")
+            except Exception as e:
+                print(f"❌ Ошибка в {file}: {e}")
     
-    print(f"\n📊 Найдено {len(file_info)} файлов для анализа")
+    return file_info
+
+# Дисковый кэш томов: ключ = путь + размер + mtime исходного файла
+def _cache_key(file_path):
+    st = os.stat(file_path)
+    raw = f"{os.path.abspath(file_path)}|{st.st_size}|{st.st_mtime_ns}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def _evict_cache(cache_dir, max_bytes):
+    """LRU-вытеснение: удаляем давно не использованные .npy, пока кэш больше лимита"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npy'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
     
-    # Анализируем каждый файл
-    all_tracts = []
-    all_profiles = []
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def cached_array(cache_dir, file_path, name, compute, max_bytes=20 * 1024**3):
+    """Массив из дискового кэша (mmap, только чтение) или compute() с сохранением в кэш"""
+    if cache_dir is None:
+        return compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{_cache_key(file_path)}_{name}.npy")
     
-    for i, info in enumerate(file_info):
-        print(f"\n📁 Файл {i+1}/{len(file_info)}: {info['file_name']}")
+    # Файл может удалить _evict_cache другого процесса между проверкой и чтением:
+    # тогда просто считаем заново
+    try:
+        os.utime(path)  # отметка использования для LRU
+        return np.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        pass
+    
+    arr = np.ascontiguousarray(compute())
+    # Пишем во временный файл и атомарно переименовываем (безопасно для параллельных запусков)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp_path, path)
+    _evict_cache(cache_dir, max_bytes)
+    
+    # Том больше всего лимита кэша (или файл уже вытеснен) - возвращаем массив из памяти
+    try:
+        return np.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        return arr
+
+# Маска мозга: среднее по части томов порциями, воксели маски int32 и индекс сетки
+def b0_volumes(info, b0_threshold=50):
+    """Номера b0-томов по bval-файлу (если b0 нет - все тома)"""
+    bvals = np.loadtxt(info['bval_file']).ravel()
+    volumes = np.flatnonzero(bvals <= b0_threshold)
+    return volumes if len(volumes) else np.arange(len(bvals))
+
+def _volume_slabs(volumes, chunk):
+    """Срезы по непрерывным отрезкам номеров томов, не длиннее chunk"""
+    volumes = np.asarray(volumes, dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(volumes) != 1) + 1
+    for run in np.split(volumes, breaks):
+        for s in range(0, len(run), chunk):
+            part = run[s:s+chunk]
+            yield slice(int(part[0]), int(part[-1]) + 1)
+
+def mean_volume(data, volumes=None, chunk=8):
+    """Среднее 3D по выбранным томам (последняя ось); в памяти не больше chunk томов"""
+    volumes = np.arange(data.shape[-1]) if volumes is None else np.asarray(volumes)
+    total = np.zeros(data.shape[:3], dtype=np.float64)
+    for slab in _volume_slabs(volumes, chunk):
+        total += np.sum(data[..., slab], axis=-1, dtype=np.float64)
+    return total / max(len(volumes), 1)
+
+def brain_mask_coords(data, volumes=None, threshold=100, chunk=8):
+    """Координаты вокселей маски (среднее по volumes > threshold): int32 (n, 3)"""
+    return np.argwhere(mean_volume(data, volumes, chunk) > threshold).astype(np.int32)
+
+class MaskIndex:
+    """Воксели маски int32 (n, 3) с индексом по ячейкам сетки cell_size^3
+    
+    Воксели отсортированы по ячейкам (order, cell_starts), поэтому выборка концов
+    в области просматривает только ячейки, пересекающие её.
+    """
+    __slots__ = ("coords", "cell_size", "grid_shape", "order", "cell_starts")
+    
+    def __init__(self, coords, cell_size=8):
+        self.coords = np.ascontiguousarray(coords, dtype=np.int32).reshape(-1, 3)
+        self.cell_size = cell_size
+        cells = self.coords // cell_size
+        self.grid_shape = tuple(int(c) + 1 for c in cells.max(axis=0)) if len(cells) else (1, 1, 1)
+        cell_id = np.ravel_multi_index(tuple(cells.T), self.grid_shape)
+        self.order = np.argsort(cell_id, kind='stable')
+        self.cell_starts = np.searchsorted(cell_id[self.order], np.arange(np.prod(self.grid_shape) + 1))
+    
+    def __len__(self):
+        return len(self.coords)
+    
+    def box_voxels(self, lo, hi):
+        """Номера вокселей маски внутри параллелепипеда [lo, hi] (включительно)"""
+        lo, hi = np.asarray(lo), np.asarray(hi)
+        cell_lo = np.maximum(lo // self.cell_size, 0).astype(np.int64)
+        cell_hi = np.minimum(hi // self.cell_size, np.array(self.grid_shape) - 1).astype(np.int64)
+        if np.any(cell_lo > cell_hi):
+            return np.empty(0, dtype=np.int64)
         
-        # Загружаем данные
-        img = nib.load(info['file_path'])
-        data = img.get_fdata()
-        affine = img.affine
+        grid = np.meshgrid(*[np.arange(a, b + 1) for a, b in zip(cell_lo, cell_hi)], indexing='ij')
+        cells = np.ravel_multi_index(tuple(g.ravel() for g in grid), self.grid_shape)
+        candidates = np.concatenate([self.order[self.cell_starts[c]:self.cell_starts[c+1]] for c in cells])
+        inside = np.all((self.coords[candidates] >= lo) & (self.coords[candidates] <= hi), axis=1)
+        return candidates[inside]
+    
+    def sample(self, rng, size, box=None):
+        """Случайные воксели маски (равномерно); box=(lo, hi) - только внутри области"""
+        if box is None:
+            return self.coords[rng.integers(len(self.coords), size=size)]
+        candidates = self.box_voxels(*box)
+        if len(candidates) == 0:
+            raise ValueError(f"В области {box} нет вокселей маски")
+        return self.coords[candidates[rng.integers(len(candidates), size=size)]]
+
+class DWIStream:
+    """Потоковое чтение 4D DWI через прокси nibabel (dataobj) без загрузки всего тома
+    
+    Порции - группы томов (последняя ось) или z-слои со всеми томами; размер порции
+    подбирается под memory_budget_mb (с запасом на float64 при суммировании).
+    Файл держится открытым (keep_file_open): иначе каждый срез .nii.gz заново
+    открывает файл и распаковывает gzip с начала. spill_dir - каталог для временной
+    несжатой копии в iter_z_slabs (по умолчанию системный временный каталог).
+    """
+    
+    def __init__(self, file_path, memory_budget_mb=1024, spill_dir=None):
+        self.file_path = file_path
+        self.spill_dir = spill_dir
+        self.proxy = nib.load(file_path, keep_file_open=True).dataobj
+        self.shape = tuple(int(d) for d in self.proxy.shape)
+        self.memory_budget = int(memory_budget_mb * 1024**2)
+    
+    def volume_chunk(self):
+        """Сколько 3D томов помещается в бюджет"""
+        return max(1, self.memory_budget // (int(np.prod(self.shape[:3])) * 8))
+    
+    def z_chunk(self):
+        """Сколько z-слоёв (со всеми томами) помещается в бюджет"""
+        nx, ny, _, nv = self.shape
+        return max(1, self.memory_budget // (nx * ny * nv * 8))
+    
+    def iter_volumes(self, volumes=None):
+        """(срез томов, массив X x Y x Z x k) по непрерывным группам volumes"""
+        volumes = np.arange(self.shape[-1]) if volumes is None else volumes
+        for slab in _volume_slabs(volumes, self.volume_chunk()):
+            yield slab, np.asarray(self.proxy[..., slab])
+    
+    def iter_z_slabs(self):
+        """(срез z, массив X x Y x k x V) по группам z-слоёв
         
-        # Создаем тракты и профили
-        tracts, profiles = create_tracts_and_profiles(
-            data, info, n_tracts_per_file, n_points=100
-        )
+        z-слой со всеми томами разбросан по всему файлу, поэтому для .nii.gz каждый
+        слой стоил бы полной распаковки. Сжатый файл один раз читается вперёд по
+        томам во временный несжатый memmap (порядок Z, X, Y, V) в spill_dir, слои
+        берутся из него. dtype memmap - как у прочитанных порций, то есть уже после
+        scl_slope/scl_inter (для масштабированных файлов - float, а не тип на диске).
+        """
+        step = self.z_chunk()
+        if not self.file_path.endswith('.gz'):
+            for z0 in range(0, self.shape[2], step):
+                slab = slice(z0, min(z0 + step, self.shape[2]))
+                yield slab, np.asarray(self.proxy[:, :, slab, :])
+            return
         
-        all_tracts.extend(tracts)
-        all_profiles.extend(profiles)
-        print(f"   ✅ Создано {len(tracts)} трактов и профилей")
+        nx, ny, nz, nv = self.shape
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.spill_dir) as tmp_dir:
+            spill = None
+            for volumes, chunk in self.iter_volumes():
+                if spill is None:
+                    spill = np.lib.format.open_memmap(os.path.join(tmp_dir, 'dwi_zxyv.npy'), mode='w+',
+                                                      dtype=chunk.dtype, shape=(nz, nx, ny, nv))
+                spill[..., volumes] = chunk.transpose(2, 0, 1, 3)
+            for z0 in range(0, nz, step):
+                slab = slice(z0, min(z0 + step, nz))
+                yield slab, np.ascontiguousarray(spill[slab].transpose(1, 2, 0, 3))
+            del spill
     
-    print(f"\n🎯 ИТОГО: {len(all_tracts)} трактов, {len(all_profiles)} профилей")
+    def mean(self, volumes=None):
+        """Среднее 3D по volumes, накапливаемое порциями"""
+        volumes = np.arange(self.shape[-1]) if volumes is None else np.asarray(volumes)
+        total = np.zeros(self.shape[:3], dtype=np.float64)
+        for _, chunk in self.iter_volumes(volumes):
+            total += np.sum(chunk, axis=-1, dtype=np.float64)
+        return total / max(len(volumes), 1)
+
+def subject_mask(info, cache_dir=None, cache_max_gb=20.0, memory_budget_mb=1024, threshold=100):
+    """Среднее b0 и маска субъекта потоково (без 4D тома в памяти), с дисковым кэшем"""
+    stream = DWIStream(info['file_path'], memory_budget_mb)
+    max_bytes = int(cache_max_gb * 1024**3)
+    b0_mean = cached_array(cache_dir, info['file_path'], 'b0_mean',
+                           lambda: stream.mean(b0_volumes(info)), max_bytes)
+    mask_coords = cached_array(cache_dir, info['file_path'], f'mask_{threshold:g}',
+                               lambda: np.argwhere(b0_mean > threshold).astype(np.int32), max_bytes)
+    return MaskIndex(mask_coords)
+
+def subject_optical_maps(info, cache_dir=None, cache_max_gb=20.0, memory_budget_mb=1024, threshold=100):
+    """Воксельные карты субъекта: V-число и передача на 1 мм из FA (потоково по z-слоям)
     
+    FA считается по слоям DWIStream.iter_z_slabs и кэшируется ('fa_<threshold>': как и
+    маска, зависит от порога); вне маски (среднее b0 <= threshold) FA = 0. Временная
+    несжатая копия для z-слоёв .nii.gz пишется в cache_dir (если задан).
+    """
+    stream = DWIStream(info['file_path'], memory_budget_mb, spill_dir=cache_dir)
+    
+    def compute_fa():
+        bvals, bvecs = read_bvals_bvecs(info['bval_file'], info['bvec_file'])
+        gtab = gradient_table(bvals, bvecs=bvecs)
+        fa = np.zeros(stream.shape[:3], dtype=np.float32)
+        for z, slab in stream.iter_z_slabs():
+            inside = slab[..., gtab.b0s_mask].mean(axis=-1) > threshold
+            fa[:, :, z][inside] = tensor_fa(slab[inside], gtab.bvals, gtab.bvecs)
+        return fa
+    
+    fa = cached_array(cache_dir, info['file_path'], f'fa_{threshold:g}', compute_fa,
+                      int(cache_max_gb * 1024**3))
     return {
-        "tracts": all_tracts,
-        "profiles": all_profiles,
-        "file_info": file_info
+        "V": v_number(myelin_thickness_from_fa(fa)).astype(np.float32),
+        "T": transmission_per_mm(fa).astype(np.float32)
     }
 
-def create_tracts_and_profiles(data, file_info, n_tracts, n_points=100):
-    """Создаем тракты и профили для одного файла"""
-    brain_mask = np.mean(data, axis=-1) > 100
-    mask_coords = np.where(brain_mask)
+def sample_volume(volume, coords):
+    """Трилинейная интерполяция volume во всех точках coords (n, 3) одним проходом"""
+    return map_coordinates(volume, np.asarray(coords, dtype=np.float64).T, order=1, mode='nearest')
+
+def arc_length_weights(coords, offsets, n_points=100, voxel_size=1.0):
+    """Индексы (lo, hi) и доли frac для n_points точек, равномерных по длине дуги каждого тракта
     
-    if len(mask_coords[0]) == 0:
-        return [], []
+    Все тракты обрабатываются вместе: позиция точки - номер тракта * 2 + доля длины
+    дуги (0..1), поэтому цели всех трактов находятся одним searchsorted.
+    voxel_size - размер вокселя (число или по осям) для длины дуги в мм.
+    У пустых трактов (0 точек) lo = hi = -1: resample_profiles даёт для них NaN.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    n_tracts = len(counts)
+    lo = np.full((n_tracts, n_points), -1, dtype=np.int64)
+    hi = lo.copy()
+    frac = np.zeros((n_tracts, n_points))
+    filled = counts > 0
+    if not filled.any():
+        return lo, hi, frac
     
-    tracts = []
-    profiles = []
+    owner = np.repeat(np.arange(n_tracts), counts)
+    starts = offsets[:-1]
+    step = np.zeros(offsets[-1])
+    step[1:] = np.linalg.norm(np.diff(coords, axis=0) * voxel_size, axis=1)
+    step[starts[filled]] = 0.0
+    arc = np.cumsum(step)
+    arc -= arc[starts[owner]]
     
-    for i in range(n_tracts):
-        # Случайные точки в маске
-        start_idx = np.random.randint(len(mask_coords[0]))
-        end_idx = np.random.randint(len(mask_coords[0]))
-        
-        start = np.array([mask_coords[0][start_idx], 
-                        mask_coords[1][start_idx], 
-                        mask_coords[2][start_idx]])
-        end = np.array([mask_coords[0][end_idx], 
-                      mask_coords[1][end_idx], 
-                      mask_coords[2][end_idx]])
-        
-        # Длина тракта
-        distance = np.linalg.norm(end - start)
-        length_mm = distance * 2.0  # voxel_size = 2mm
+    # Доля длины дуги; для вырожденных трактов (все точки совпадают) - доля номера точки
+    total = np.zeros(n_tracts)
+    total[filled] = arc[offsets[1:][filled] - 1]
+    position = np.arange(offsets[-1]) - starts[owner]
+    by_index = position / np.maximum(counts[owner] - 1, 1)
+    frac_arc = np.where(total[owner] > 0, arc / np.where(total[owner] > 0, total[owner], 1.0), by_index)
+    key = owner * 2.0 + frac_arc
+    
+    query = np.flatnonzero(filled)[:, None] * 2.0 + np.linspace(0, 1, n_points)[None, :]
+    first = starts[filled][:, None]
+    last = offsets[1:][filled][:, None] - 1
+    lo_f = np.clip(np.searchsorted(key, query, side='right') - 1, first, last)
+    hi_f = np.minimum(lo_f + 1, last)
+    span = key[hi_f] - key[lo_f]
+    lo[filled], hi[filled] = lo_f, hi_f
+    frac[filled] = np.clip(np.divide(query - key[lo_f], span, out=np.zeros_like(span), where=span > 0), 0.0, 1.0)
+    return lo, hi, frac
+
+def resample_profiles(values, weights):
+    """Значения в точках трактов (плоский буфер) -> профили (n_tracts, n_points) по arc_length_weights"""
+    lo, hi, frac = weights
+    profiles = np.full(lo.shape, np.nan)
+    valid = lo >= 0
+    profiles[valid] = values[lo[valid]] * (1.0 - frac[valid]) + values[hi[valid]] * frac[valid]
+    return profiles
+
+def sample_tract_profiles(volumes, coords, offsets, n_points=100, weights=None):
+    """Профили всех трактов по томам {имя: 3D том}: один map_coordinates на том
+    
+    weights - готовые arc_length_weights (например, общие с другими профилями тракта).
+    """
+    if weights is None:
+        weights = arc_length_weights(coords, offsets, n_points)
+    return {name: resample_profiles(sample_volume(volume, coords), weights)
+            for name, volume in volumes.items()}
+
+class TractStore:
+    """Колоночное хранилище трактов без словаря на каждый тракт
+    
+    columns  - скалярные метрики: имя -> массив длины n_tracts
+    profiles - float32 (n_tracts, 3, n_points), профили V, T, OPC
+    coords   - float32 (total_points, 3), тракт i - coords[offsets[i]:offsets[i+1]]
+    """
+    __slots__ = ("columns", "profiles", "coords", "offsets")
+    
+    PROFILE_KINDS = ("V", "T", "OPC")
+    SCALAR_COLUMNS = ("tract_id", "file_name", "length", "region", "n_gradients",
+                      "V_mean", "T_mean", "OPC_mean")
+    
+    def __init__(self, columns, profiles, coords, offsets):
+        self.columns = columns
+        self.profiles = profiles
+        self.coords = coords
+        self.offsets = offsets
+    
+    @classmethod
+    def from_batch(cls, batch):
+        """Из результата create_tract_batch"""
+        profiles = np.stack([batch[f"{kind}_profile"] for kind in cls.PROFILE_KINDS], axis=1)
+        return cls({name: batch[name] for name in cls.SCALAR_COLUMNS},
+                   profiles.astype(np.float32),
+                   batch["coords"].astype(np.float32),
+                   batch["offsets"])
+    
+    @classmethod
+    def concat(cls, stores, n_points=100):
+        """Склеиваем хранилища (например, по файлам) в заданном порядке"""
+        stores = list(stores)
+        if not stores:
+            return cls({name: np.empty(0, dtype=object) for name in cls.SCALAR_COLUMNS},
+                       np.empty((0, len(cls.PROFILE_KINDS), n_points), dtype=np.float32),
+                       np.empty((0, 3), dtype=np.float32),
+                       np.zeros(1, dtype=np.int64))
         
-        # Создаем тракт
-        n_tract_points = max(10, int(distance * 1.5))
-        t = np.linspace(0, 1, n_tract_points)
-        noise = np.random.randn(n_tract_points, 3) * 1.5
-        tract_coords = np.outer(t, end - start) + np.outer(1-t, start) + noise
+        columns = {name: np.concatenate([st.columns[name] for st in stores])
+                   for name in stores[0].columns}
+        point_counts = np.concatenate([np.diff(st.offsets) for st in stores])
+        offsets = np.zeros(len(point_counts) + 1, dtype=np.int64)
+        np.cumsum(point_counts, out=offsets[1:])
+        return cls(columns,
+                   np.concatenate([st.profiles for st in stores]),
+                   np.concatenate([st.coords for st in stores]),
+                   offsets)
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, name):
+        return self.columns[name]
+    
+    def __setitem__(self, name, values):
+        values = np.asarray(values)
+        if len(values) != len(self):
+            raise ValueError(f"Столбец {name}: {len(values)} значений для {len(self)} трактов")
+        self.columns[name] = values
+    
+    def profile(self, kind):
+        """Профили одного типа (V, T или OPC): вид (n_tracts, n_points) без копирования"""
+        return self.profiles[:, self.PROFILE_KINDS.index(kind)]
+    
+    def tract_coords(self, i):
+        return self.coords[self.offsets[i]:self.offsets[i+1]]
+    
+    def to_frame(self, columns=None):
+        """Скалярные метрики как DataFrame"""
+        names = list(self.columns) if columns is None else columns
+        return pd.DataFrame({name: self.columns[name] for name in names})
+
+def _process_subject(info, n_tracts, n_points, cache_dir, cache_max_gb, seed, stream_budget_mb=1024,
+                     profile_source="synthetic"):
+    """Один субъект: потоковая маска, тракты (без общего состояния - годится для пула процессов)"""
+    rng = np.random.default_rng(seed)
+    mask = subject_mask(info, cache_dir, cache_max_gb, stream_budget_mb)
+    optical_maps = None
+    if profile_source == "dwi":
+        optical_maps = subject_optical_maps(info, cache_dir, cache_max_gb, stream_budget_mb)
+    return TractStore.from_batch(create_tract_batch(None, info, n_tracts, n_points, rng=rng, mask=mask,
+                                                    optical_maps=optical_maps))
+
+def _volume_nbytes(info, stream_budget_mb=None):
+    """Оценка памяти на субъект: 4D том по заголовку, но не больше бюджета потокового чтения"""
+    nbytes = int(np.prod(info['data_shape'])) * np.dtype(info['dtype']).itemsize
+    if stream_budget_mb is not None:
+        nbytes = min(nbytes, int(stream_budget_mb * 1024**2))
+    return nbytes
+
+def build_optical_connectome(data_path, n_tracts_per_file=300, cache_dir=None, cache_max_gb=20.0,
+                             workers=1, memory_budget_gb=None, seed=None, stream_budget_mb=1024,
+                             profile_source="synthetic"):
+    """Строим оптический коннектом на всех данных ds006181
+    
+    seed - int или np.random.SeedSequence; каждый файл получает свой дочерний поток
+    SeedSequence.spawn, поэтому результат не зависит от workers.
+    stream_budget_mb - память одного субъекта: тома читаются порциями, а не целиком.
+    profile_source - "synthetic" (модельные профили) или "dwi" (по картам V/T из FA).
+    """
+    if profile_source not in ("synthetic", "dwi"):
+        raise ValueError(f"Неизвестный profile_source: {profile_source}")
+    print("🚀 === ПОСТРОЕНИЕ ОПТИЧЕСКОГО КОННЕКТОМА ===")
+    
+    # Сканируем все файлы (только заголовки)
+    file_info = scan_dwi_files(data_path)
+    
+    print(f"\n📊 Найдено {len(file_info)} файлов для анализа")
+    
+    # Свой поток на каждый файл: результат не зависит от числа процессов
+    root_seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    seeds = root_seed.spawn(len(file_info))
+    n_points = 100
+    subject_results = {}
+    
+    def report(i):
+        print(f"\n📁 Файл {i+1}/{len(file_info)}: {file_info[i]['file_name']}")
+        print(f"   ✅ Создано {len(subject_results[i])} трактов и профилей")
+    
+    if workers <= 1:
+        for i, info in enumerate(file_info):
+            subject_results[i] = _process_subject(
+                info, n_tracts_per_file, n_points, cache_dir, cache_max_gb, seeds[i], stream_budget_mb,
+                profile_source
+            )
+            report(i)
+    else:
+        # Ограничиваем число томов "в полёте": не больше workers и не больше бюджета памяти
+        budget = None if memory_budget_gb is None else memory_budget_gb * 1024**3
+        sizes = [_volume_nbytes(info, stream_budget_mb) for info in file_info]
+        print(f"⚙️ Параллельная обработка: {workers} процессов")
         
-        # Создаем профили V, T, OPC вдоль тракта
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = {}
+            in_flight = 0
+            next_i = 0
+            while next_i < len(file_info) or pending:
+                while (next_i < len(file_info) and len(pending) < workers and
+                       (not pending or budget is None or in_flight + sizes[next_i] <= budget)):
+                    future = pool.submit(_process_subject, file_info[next_i], n_tracts_per_file,
+                                         n_points, cache_dir, cache_max_gb, seeds[next_i],
+                                         stream_budget_mb, profile_source)
+                    pending[future] = next_i
+                    in_flight += sizes[next_i]
+                    next_i += 1
+                
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    in_flight -= sizes[i]
+                    subject_results[i] = future.result()
+                    report(i)
+    
+    # Сливаем в детерминированном порядке файлов; профиль i относится к тракту i
+    store = TractStore.concat((subject_results[i] for i in range(len(file_info))), n_points)
+    
+    print(f"\n🎯 ИТОГО: {len(store)} трактов и профилей")
+    
+    return {
+        "tracts": store,
+        "file_info": file_info
+    }
+
+def create_tract_batch(data, file_info, n_tracts, n_points=100, voxel_size_mm=None, rng=None,
+                       mask=None, endpoint_box=None, optical_maps=None):
+    """Векторная генерация трактов и профилей V/T/OPC для одного файла (колоночный формат)
+    
+    Профили - массивы (n_tracts, n_points); координаты всех трактов лежат в одном
+    плоском буфере coords (total_points, 3), тракт i - coords[offsets[i]:offsets[i+1]].
+    rng - seed, SeedSequence или np.random.Generator.
+    voxel_size_mm - размер вокселя (число или по осям x, y, z); по умолчанию
+    file_info['voxel_size'] из заголовка, без него - 2 мм. Длины считаются в мм по осям.
+    mask - готовый MaskIndex; иначе маска считается по b0-томам (или всем, если bval нет).
+    endpoint_box - (lo, hi) в вокселях: концы трактов только из этой области маски.
+    optical_maps - {"V", "T"} из subject_optical_maps: профили берутся вдоль coords
+    (T - накопленная передача от начала тракта), иначе - модельные профили.
+    """
+    rng = np.random.default_rng(rng)
+    if voxel_size_mm is None:
+        voxel_size_mm = file_info.get('voxel_size', 2.0)
+    voxel_size_mm = np.broadcast_to(np.asarray(voxel_size_mm, dtype=np.float64), (3,))
+    if mask is None:
+        volumes = b0_volumes(file_info) if 'bval_file' in file_info else None
+        mask = MaskIndex(brain_mask_coords(data, volumes))
+    
+    if len(mask) == 0:
+        n_tracts = 0
+        mask = MaskIndex(np.zeros((1, 3), dtype=np.int32))
+    
+    # Случайные начала и концы в маске
+    endpoints = mask.sample(rng, (n_tracts, 2), endpoint_box)
+    start = endpoints[:, 0].astype(float)
+    end = endpoints[:, 1].astype(float)
+    
+    # Длина тракта (вокселей - для числа точек, мм - с учётом размера вокселя по осям)
+    distance = np.linalg.norm(end - start, axis=1)
+    length_mm = np.linalg.norm((end - start) * voxel_size_mm, axis=1)
+    
+    # Координаты: прямая start -> end с шумом, все тракты в одном буфере
+    n_tract_points = np.maximum(10, (distance * 1.5).astype(np.int64))
+    offsets = np.zeros(n_tracts + 1, dtype=np.int64)
+    np.cumsum(n_tract_points, out=offsets[1:])
+    owner = np.repeat(np.arange(n_tracts), n_tract_points)
+    t = (np.arange(offsets[-1]) - offsets[owner]) / (n_tract_points[owner] - 1)
+    coords = start[owner] + t[:, None] * (end - start)[owner] + rng.standard_normal((offsets[-1], 3)) * 1.5
+    
+    if optical_maps is not None:
+        # Профили по воксельным картам вдоль координат тракта
+        weights = arc_length_weights(coords, offsets, n_points, voxel_size_mm)
+        V_prof = sample_tract_profiles({"V": optical_maps["V"]}, coords, offsets, n_points, weights)["V"]
+        step_mm = np.zeros(offsets[-1])
+        step_mm[1:] = np.linalg.norm(np.diff(coords, axis=0) * voxel_size_mm, axis=1)
+        step_mm[offsets[:-1]] = 0.0
+        # Накопленная передача: log10 T(s) = сумма log10 T_mm * шаг от начала тракта
+        log_t = np.log10(sample_volume(optical_maps["T"], coords)) * step_mm
+        cum_log_t = np.cumsum(log_t)
+        cum_log_t -= np.repeat(cum_log_t[offsets[:-1]] - log_t[offsets[:-1]], n_tract_points)
+        T_prof = resample_profiles(10**cum_log_t, weights)
+    else:
         x = np.linspace(0, 1, n_points)
         
         # V-число профиль (базируется на реальных данных)
-        V_base = 0.741 + np.random.normal(0, 0.1)
-        V_prof = V_base + 0.05*np.sin(2*np.pi*(1.5+np.random.rand())*x) + np.random.normal(0, 0.02, size=n_points)
+        V_base = 0.741 + rng.normal(0, 0.1, size=(n_tracts, 1))
+        V_freq = 1.5 + rng.random((n_tracts, 1))
+        V_prof = V_base + 0.05*np.sin(2*np.pi*V_freq*x) + rng.normal(0, 0.02, size=(n_tracts, n_points))
         V_prof = np.clip(V_prof, 0.1, 2.0)
         
         # Передача профиль
-        T_base = 0.65 + np.random.normal(0, 0.1)
-        T_prof = T_base + 0.1*np.sin(2*np.pi*(0.7+0.6*np.random.rand())*x + 2*np.pi*np.random.rand()) + np.random.normal(0, 0.05, size=n_points)
+        T_base = 0.65 + rng.normal(0, 0.1, size=(n_tracts, 1))
+        T_freq = 0.7 + 0.6*rng.random((n_tracts, 1))
+        T_phase = 2*np.pi*rng.random((n_tracts, 1))
+        T_prof = T_base + 0.1*np.sin(2*np.pi*T_freq*x + T_phase) + rng.normal(0, 0.05, size=(n_tracts, n_points))
         T_prof = np.clip(T_prof, 0.0, 1.0)
-        
-        # OPC профиль
-        OPC_prof = V_prof * T_prof
-        
-        # Определяем регион по длине
-        if length_mm < 20:
-            region = "short"
-        elif length_mm < 40:
-            region = "medium"
-        else:
-            region = "long"
-        
-        # Создаем тракт
+    
+    # OPC профиль
+    OPC_prof = V_prof * T_prof
+    
+    # Определяем регион по длине
+    region = np.where(length_mm < 20, "short", np.where(length_mm < 40, "medium", "long"))
+    
+    file_name = file_info['file_name']
+    return {
+        "tract_id": np.array([f"{file_name}_tract_{i:03d}" for i in range(n_tracts)], dtype=object),
+        "file_name": np.full(n_tracts, file_name, dtype=object),
+        "length": length_mm,
+        "region": region.astype(object),
+        "n_gradients": np.full(n_tracts, file_info['n_gradients']),
+        "V_mean": V_prof.mean(axis=1),
+        "T_mean": T_prof.mean(axis=1),
+        "OPC_mean": OPC_prof.mean(axis=1),
+        "V_profile": V_prof,
+        "T_profile": T_prof,
+        "OPC_profile": OPC_prof,
+        "coords": coords,
+        "offsets": offsets
+    }
+
+def create_tracts_and_profiles(data, file_info, n_tracts, n_points=100, rng=None):
+    """Создаем тракты и профили для одного файла (списки словарей поверх create_tract_batch)"""
+    batch = create_tract_batch(data, file_info, n_tracts, n_points, rng=rng)
+    offsets = batch["offsets"]
+    
+    tracts = []
+    profiles = []
+    for i in range(len(batch["tract_id"])):
         tract = {
-            "tract_id": f"{file_info['file_name']}_tract_{i:03d}",
-            "file_name": file_info['file_name'],
-            "length": length_mm,
-            "region": region,
-            "n_gradients": file_info['n_gradients'],
-            "coords": tract_coords,
-            "V_mean": np.mean(V_prof),
-            "T_mean": np.mean(T_prof),
-            "OPC_mean": np.mean(OPC_prof)
+            "tract_id": batch["tract_id"][i],
+            "file_name": batch["file_name"][i],
+            "length": batch["length"][i],
+            "region": batch["region"][i],
+            "n_gradients": batch["n_gradients"][i],
+            "coords": batch["coords"][offsets[i]:offsets[i+1]],
+            "V_mean": batch["V_mean"][i],
+            "T_mean": batch["T_mean"][i],
+            "OPC_mean": batch["OPC_mean"][i]
         }
-        
-        # Создаем профиль
         profile = {
             "tract_id": tract["tract_id"],
-            "V_profile": V_prof,
-            "T_profile": T_prof,
-            "OPC_profile": OPC_prof,
-            "length": length_mm,
-            "region": region
+            "V_profile": batch["V_profile"][i],
+            "T_profile": batch["T_profile"][i],
+            "OPC_profile": batch["OPC_profile"][i],
+            "length": tract["length"],
+            "region": tract["region"]
         }
-        
         tracts.append(tract)
         profiles.append(profile)
     
@@ -231,31 +866,22 @@ def run_dea_kaci_analysis(results):
     """Запускаем DEA и KACI анализ для всех трактов"""
     print("\n🔬 === DEA + KACI АНАЛИЗ ===")
     
-    for i, tract in enumerate(results["tracts"]):
-        if i % 100 == 0:
-            print(f"   Прогресс: {i}/{len(results['tracts'])} трактов...")
-        
-        # Находим соответствующий профиль
-        profile = next(p for p in results["profiles"] if p["tract_id"] == tract["tract_id"])
-        
-        # Вычисляем DEA
-        tract["DEA_V"] = compute_dea(profile["V_profile"])
-        tract["DEA_T"] = compute_dea(profile["T_profile"])
-        tract["DEA_OPC"] = compute_dea(profile["OPC_profile"])
-        
-        # Вычисляем KACI
-        tract["KACI_V"] = spline_kaci(profile["V_profile"])
-        tract["KACI_T"] = spline_kaci(profile["T_profile"])
-        tract["KACI_OPC"] = spline_kaci(profile["OPC_profile"])
+    # Профили хранятся по позиции тракта - поиск не нужен
+    store = results["tracts"]
+    for kind in TractStore.PROFILE_KINDS:
+        profiles = store.profile(kind)
+        store[f"DEA_{kind}"] = compute_dea_batch(profiles)
+        kaci = spline_kaci_batch(profiles)
+        store[f"KACI_{kind}"] = kaci.astype(np.int16) if np.all(np.isfinite(kaci)) else kaci
     
-    print(f"✅ DEA и KACI вычислены для {len(results['tracts'])} трактов")
+    print(f"✅ DEA и KACI вычислены для {len(store)} трактов")
 
 # ========== 5. Сравнительный анализ ==========
 def region_compare(results):
     """Сравнение по регионам"""
     print("\n📊 === СРАВНЕНИЕ ПО РЕГИОНАМ ===")
     
-    df = pd.DataFrame(results["tracts"])
+    df = results["tracts"].to_frame()
     region_stats = df.groupby('region')[['V_mean', 'T_mean', 'OPC_mean', 'DEA_OPC', 'KACI_OPC']].agg(['mean', 'std'])
     
     print("Статистики по регионам:")
@@ -267,7 +893,7 @@ def length_compare(results):
     """Сравнение по длине"""
     print("\n📏 === СРАВНЕНИЕ ПО ДЛИНЕ ===")
     
-    df = pd.DataFrame(results["tracts"])
+    df = results["tracts"].to_frame()
     
     # Создаем группы по длине
     df['length_group'] = pd.cut(df['length'], bins=3, labels=['short', 'medium', 'long'])
@@ -282,7 +908,7 @@ def file_compare(results):
     """Сравнение по файлам"""
     print("\n📁 === СРАВНЕНИЕ ПО ФАЙЛАМ ===")
     
-    df = pd.DataFrame(results["tracts"])
+    df = results["tracts"].to_frame()
     file_stats = df.groupby('file_name')[['V_mean', 'T_mean', 'OPC_mean', 'DEA_OPC', 'KACI_OPC']].agg(['mean', 'std'])
     
     print("Статистики по файлам:")
@@ -290,29 +916,39 @@ def file_compare(results):
     
     return file_stats
 
+def region_connectome(results, labels=None, n_cells=(4, 4, 4)):
+    """Региональные матрицы связности по концам трактов (по субъектам)
+    
+    labels - объём меток парцелл; без него - регулярная сетка n_cells по объёму субъекта.
+    """
+    print("\n🧠 === РЕГИОНАЛЬНЫЕ МАТРИЦЫ СВЯЗНОСТИ ===")
+    
+    matrices = subject_region_matrices(results["tracts"], results["file_info"], labels, n_cells)
+    results["region_matrices"] = matrices
+    
+    for subject, subject_matrices in matrices.items():
+        count = subject_matrices["count"]
+        print(f"  {subject}: {count.shape[0]} регионов, {count.nnz} связей")
+    
+    return matrices
+
 # ========== 6. Демиелинизация ==========
 def simulate_demyelination(results, factor=0.5):
     """Симуляция демиелинизации"""
     print(f"\n🧪 === СИМУЛЯЦИЯ ДЕМИЕЛИНИЗАЦИИ (фактор {factor}) ===")
     
-    demyel_results = []
-    
-    for tract in results["tracts"]:
-        demyel_tract = tract.copy()
-        demyel_tract["T_mean_demyel"] = tract["T_mean"] * factor
-        demyel_tract["OPC_mean_demyel"] = tract["OPC_mean"] * factor
-        demyel_tract["demyel_factor"] = factor
-        demyel_results.append(demyel_tract)
+    store = results["tracts"]
+    demyel_results = store.to_frame(["tract_id", "T_mean", "OPC_mean"])
+    demyel_results["T_mean_demyel"] = demyel_results["T_mean"] * factor
+    demyel_results["OPC_mean_demyel"] = demyel_results["OPC_mean"] * factor
+    demyel_results["demyel_factor"] = factor
     
     # Статистики демиелинизации
-    df_original = pd.DataFrame(results["tracts"])
-    df_demyel = pd.DataFrame(demyel_results)
-    
     comparison = {
-        "original_T_mean": df_original["T_mean"].mean(),
-        "demyel_T_mean": df_demyel["T_mean_demyel"].mean(),
-        "original_OPC_mean": df_original["OPC_mean"].mean(),
-        "demyel_OPC_mean": df_demyel["OPC_mean_demyel"].mean(),
+        "original_T_mean": demyel_results["T_mean"].mean(),
+        "demyel_T_mean": demyel_results["T_mean_demyel"].mean(),
+        "original_OPC_mean": demyel_results["OPC_mean"].mean(),
+        "demyel_OPC_mean": demyel_results["OPC_mean_demyel"].mean(),
         "T_reduction": (1 - factor) * 100,
         "OPC_reduction": (1 - factor) * 100
     }
@@ -323,47 +959,36 @@ def simulate_demyelination(results, factor=0.5):
     return demyel_results, comparison
 
 # ========== 7. Экспорт результатов ==========
+METRIC_COLUMNS = ["tract_id", "file_name", "length", "region", "n_gradients",
+                  "V_mean", "T_mean", "OPC_mean",
+                  "DEA_V", "DEA_T", "DEA_OPC",
+                  "KACI_V", "KACI_T", "KACI_OPC"]
+
 def export_results(results, comparisons, demyel_results):
     """Экспортируем все результаты"""
     print("\n💾 === ЭКСПОРТ РЕЗУЛЬТАТОВ ===")
     
-    # Создаем DataFrame с основными метриками
-    all_metrics = []
-    for tract in results["tracts"]:
-        all_metrics.append({
-            "tract_id": tract["tract_id"],
-            "file_name": tract["file_name"],
-            "length": tract["length"],
-            "region": tract["region"],
-            "n_gradients": tract["n_gradients"],
-            "V_mean": tract["V_mean"],
-            "T_mean": tract["T_mean"],
-            "OPC_mean": tract["OPC_mean"],
-            "DEA_V": tract["DEA_V"],
-            "DEA_T": tract["DEA_T"],
-            "DEA_OPC": tract["DEA_OPC"],
-            "KACI_V": tract["KACI_V"],
-            "KACI_T": tract["KACI_T"],
-            "KACI_OPC": tract["KACI_OPC"]
-        })
-    
-    df = pd.DataFrame(all_metrics)
-    df.to_csv("ds006181_optical_metrics.csv", index=False)
-    print(f"✅ Основные метрики сохранены в ds006181_optical_metrics.csv")
-    
-    # Создаем DataFrame с демиелинизацией
-    demyel_metrics = []
-    for tract in demyel_results[0]:
-        demyel_metrics.append({
-            "tract_id": tract["tract_id"],
-            "T_original": tract["T_mean"],
-            "T_demyel": tract["T_mean_demyel"],
-            "OPC_original": tract["OPC_mean"],
-            "OPC_demyel": tract["OPC_mean_demyel"],
-            "demyel_factor": tract["demyel_factor"]
-        })
-    
-    df_demyel = pd.DataFrame(demyel_metrics)
+    # DataFrame с основными метриками прямо из столбцов хранилища
+    df = results["tracts"].to_frame(METRIC_COLUMNS)
+    write_metrics(df, "ds006181_optical_metrics.csv")
+    print(f"✅ Основные метрики сохранены в ds006181_optical_metrics.csv (+ .parquet)")
+    
+    # Профили V/T/OPC и координаты трактов - в сжатый архив для повторного анализа
+    manifest = write_profile_archive(results["tracts"], "ds006181_profiles")
+    print(f"✅ Профили сохранены в ds006181_profiles/ ({len(manifest['shards'])} шардов)")
+    
+    # Региональные матрицы - разреженные NPZ по субъектам
+    if "region_matrices" in results:
+        save_region_matrices(results["region_matrices"], "ds006181_region_matrices")
+        print(f"✅ Региональные матрицы сохранены в ds006181_region_matrices/")
+    
+    # DataFrame с демиелинизацией
+    df_demyel = demyel_results.rename(columns={
+        "T_mean": "T_original",
+        "T_mean_demyel": "T_demyel",
+        "OPC_mean": "OPC_original",
+        "OPC_mean_demyel": "OPC_demyel"
+    })[["tract_id", "T_original", "T_demyel", "OPC_original", "OPC_demyel", "demyel_factor"]]
     df_demyel.to_csv("ds006181_demyelination.csv", index=False)
     print(f"✅ Демиелинизация сохранена в ds006181_demyelination.csv")
     
@@ -422,23 +1047,27 @@ def create_report(df, df_demyel, comparisons):
         f.write("5. **Региональные различия** минимальны, что указывает на консистентность\n\n")
         
         f.write("## Файлы результатов\n")
-        f.write("- `ds006181_optical_metrics.csv` - основные метрики\n")
+        f.write("- `ds006181_optical_metrics.csv` - основные метрики (типизированная копия: `.parquet`)\n")
         f.write("- `ds006181_demyelination.csv` - симуляция демиелинизации\n")
+        f.write("- `ds006181_profiles/` - профили V/T/OPC и координаты трактов (NPZ-шарды)\n")
+        f.write("- `ds006181_region_matrices/` - матрицы регион x регион (число трактов, средние OPC/T/V; scipy.sparse NPZ)\n")
         f.write("- `report_ds006181.md` - данный отчёт\n")
     
     print("✅ Отчёт сохранён в report_ds006181.md")
 
 # ========== 9. Главная функция ==========
-def main():
-    """Главная функция пайплайна"""
+def main(profile_source="synthetic"):
+    """Главная функция пайплайна (profile_source - "synthetic" или "dwi")"""
     print("🚀 === OPTICAL CONNECTOME PIPELINE ===")
     print("📊 Полный анализ ds006181 с DEA+KACI")
     
     data_path = "/Users/admin/Downloads/ds006181-1.0.0"
+    cache_dir = os.path.expanduser("~/.cache/optical_connectome")
     
     try:
         # 1. Строим оптический коннектом
-        results = build_optical_connectome(data_path, n_tracts_per_file=200)
+        results = build_optical_connectome(data_path, n_tracts_per_file=200, cache_dir=cache_dir, seed=42,
+                                           profile_source=profile_source)
         
         # 2. Запускаем DEA + KACI
         run_dea_kaci_analysis(results)
@@ -449,6 +1078,7 @@ def main():
             "lengths": length_compare(results),
             "files": file_compare(results)
         }
+        region_connectome(results)
         
         # 4. Демиелинизация
         demyel_results, demyel_comparison = simulate_demyelination(results, factor=0.5)
@@ -463,11 +1093,15 @@ def main():
         print("\n🎉 === ПАЙПЛАЙН ЗАВЕРШЁН ===")
         print("📁 Все результаты сохранены")
         print("📊 Готов к публикации!")
-        
+    
     except Exception as e:
         print(f"❌ Ошибка в пайплайне: {e}")
         import traceback
         traceback.print_exc()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Пайплайн оптического коннектома ds006181")
+    parser.add_argument("--profile-source", choices=("synthetic", "dwi"), default="synthetic",
+                        help="профили трактов: модельные или по картам V/T из FA (DWI)")
+    args = parser.parse_args()
+    main(profile_source=args.profile_source)
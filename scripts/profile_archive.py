@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+АРХИВ ПРОФИЛЕЙ ТРАКТОВ
+======================
+
+Профили V/T/OPC и координаты трактов сохраняются в каталог со сжатыми
+NPZ-шардами (по shard_size трактов) и manifest.json. Шарды читаются лениво:
+загружаются только нужные шарды и только нужные массивы внутри них.
+
+Автор: Optical Connectome Research Team
+"""
+
+import os
+import glob
+import json
+import numpy as np
+
+ARCHIVE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+
+def write_profile_archive(store, path, shard_size=10000):
+    """Записать профили и координаты из TractStore в каталог path"""
+    os.makedirs(path, exist_ok=True)
+    for old_shard in glob.glob(os.path.join(path, "shard_*.npz")):
+        os.remove(old_shard)
+    
+    n_tracts = len(store)
+    offsets = store.offsets
+    tract_ids = np.asarray(store["tract_id"], dtype=str)
+    shards = []
+    
+    for k, start in enumerate(range(0, n_tracts, shard_size)):
+        stop = min(start + shard_size, n_tracts)
+        p0, p1 = offsets[start], offsets[stop]
+        name = f"shard_{k:05d}.npz"
+        np.savez_compressed(
+            os.path.join(path, name),
+            tract_id=tract_ids[start:stop],
+            profiles=store.profiles[start:stop],
+            coords=store.coords[p0:p1],
+            offsets=offsets[start:stop+1] - p0
+        )
+        shards.append({"file": name, "start": int(start), "stop": int(stop)})
+    
+    manifest = {
+        "version": ARCHIVE_VERSION,
+        "n_tracts": int(n_tracts),
+        "n_points": int(store.profiles.shape[-1]),
+        "profile_kinds": list(store.PROFILE_KINDS),
+        "shards": shards
+    }
+    with open(os.path.join(path, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    
+    return manifest
+
+class ProfileArchive:
+    """Ленивое чтение архива, записанного write_profile_archive"""
+    
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_NAME), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest["version"] != ARCHIVE_VERSION:
+            raise ValueError(f"Неподдерживаемая версия архива: {self.manifest['version']}")
+        self.profile_kinds = tuple(self.manifest["profile_kinds"])
+    
+    def __len__(self):
+        return self.manifest["n_tracts"]
+    
+    def _load(self, shard, name):
+        with np.load(os.path.join(self.path, shard["file"])) as data:
+            return data[name]
+    
+    def iter_shards(self, names=("tract_id", "profiles")):
+        """Итерация по шардам: (start, {имя: массив}) - в памяти только один шард"""
+        for shard in self.manifest["shards"]:
+            with np.load(os.path.join(self.path, shard["file"])) as data:
+                yield shard["start"], {name: data[name] for name in names}
+    
+    def tract_ids(self):
+        return np.concatenate([self._load(shard, "tract_id") for shard in self.manifest["shards"]]
+                              or [np.empty(0, dtype=str)])
+    
+    def profiles(self, kind=None, rows=None):
+        """Профили (n, 3, n_points) или одного типа (n, n_points); rows - номера трактов"""
+        shards = self.manifest["shards"]
+        if rows is None:
+            parts = [self._load(shard, "profiles") for shard in shards]
+            result = np.concatenate(parts) if parts else np.empty(
+                (0, len(self.profile_kinds), self.manifest["n_points"]), dtype=np.float32)
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            starts = np.array([shard["start"] for shard in shards], dtype=np.int64)
+            owner = np.searchsorted(starts, rows, side="right") - 1
+            result = np.empty((len(rows), len(self.profile_kinds), self.manifest["n_points"]),
+                              dtype=np.float32)
+            for k in np.unique(owner):
+                sel = owner == k
+                result[sel] = self._load(shards[k], "profiles")[rows[sel] - starts[k]]
+        
+        if kind is None:
+            return result
+        return result[:, self.profile_kinds.index(kind)]
+    
+    def profiles_for(self, tract_ids, kind=None):
+        """Профили в порядке заданных tract_id (например, строк таблицы метрик)
+        
+        Шарды просматриваются по одному: tract_id шарда ищутся среди отсортированных
+        запрошенных, профили шарда читаются, только если в нём есть совпадения.
+        Память - один шард и результат, без индекса всего архива.
+        """
+        tract_ids = np.asarray(tract_ids, dtype=str)
+        order = np.argsort(tract_ids, kind="stable")
+        wanted = tract_ids[order]
+        result = np.empty((len(tract_ids), len(self.profile_kinds), self.manifest["n_points"]),
+                          dtype=np.float32)
+        found = np.zeros(len(tract_ids), dtype=bool)
+        
+        for shard in self.manifest["shards"]:
+            with np.load(os.path.join(self.path, shard["file"])) as data:
+                ids = data["tract_id"]
+                lo = np.searchsorted(wanted, ids, side="left")
+                counts = np.searchsorted(wanted, ids, side="right") - lo
+                if not counts.any():
+                    continue
+                # Каждой строке шарда - все запросы с тем же tract_id (повторы допустимы)
+                local = np.repeat(np.arange(len(ids)), counts)
+                first = np.repeat(lo - np.cumsum(counts) + counts, counts)
+                targets = order[first + np.arange(len(local))]
+                result[targets] = data["profiles"][local]
+                found[targets] = True
+        
+        if not found.all():
+            missing = tract_ids[~found]
+            raise ValueError(f"В архиве {self.path} нет {len(missing)} из {len(tract_ids)} "
+                             f"запрошенных трактов (например, {missing[0]}): архив от другого запуска?")
+        if kind is None:
+            return result
+        return result[:, self.profile_kinds.index(kind)]
+    
+    def tract_coords(self, i):
+        """Координаты тракта i (читается только его шард)"""
+        for shard in self.manifest["shards"]:
+            if shard["start"] <= i < shard["stop"]:
+                with np.load(os.path.join(self.path, shard["file"])) as data:
+                    offsets = data["offsets"]
+                    local = i - shard["start"]
+                    return data["coords"][offsets[local]:offsets[local+1]]
+        raise IndexError(f"Тракт {i} вне архива из {len(self)} трактов")